@@ -242,17 +242,22 @@
     "import re\n",
     "from bs4 import BeautifulSoup\n",
     "\n",
-    "def review_to_words(review):\n",
+    "def strip_html(review):\n",
+    "    return BeautifulSoup(review, \"html.parser\").get_text() # Remove HTML tags\n",
+    "\n",
+    "def text_to_words(text):\n",
     "    nltk.download(\"stopwords\", quiet=True)\n",
     "    stemmer = PorterStemmer()\n",
     "    \n",
-    "    text = BeautifulSoup(review, \"html.parser\").get_text() # Remove HTML tags\n",
     "    text = re.sub(r\"[^a-zA-Z0-9]\", \" \", text.lower()) # Convert to lower case\n",
     "    words = text.split() # Split string into words\n",
     "    words = [w for w in words if w not in stopwords.words(\"english\")] # Remove stopwords\n",
     "    words = [PorterStemmer().stem(w) for w in words] # stem\n",
     "    \n",
-    "    return words"
+    "    return words\n",
+    "\n",
+    "def review_to_words(review):\n",
+    "    return text_to_words(strip_html(review))"
    ]
   },
   {
@@ -1025,6 +1030,26 @@
     "        .to_csv(os.path.join(data_dir, 'train.csv'), header=False, index=False)"
    ]
   },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "It is also useful to keep a binary copy of the same data. Below we store the packed `length, review[500]` rows and the labels as `.npy` files. Unlike the CSV file, these can be memory-mapped, so later on we can read individual rows directly from disk instead of loading (and copying) the whole training set into memory."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "mmap_dir = '../data/pytorch_mmap' # Kept outside of data_dir so that it is not uploaded to S3\n",
+    "os.makedirs(mmap_dir, exist_ok=True)\n",
+    "\n",
+    "np.save(os.path.join(mmap_dir, 'train_X.npy'), np.hstack((train_X_len.reshape(-1, 1), train_X)).astype(np.int64))\n",
+    "np.save(os.path.join(mmap_dir, 'train_y.npy'), np.array(train_y, dtype=np.float32))"
+   ]
+  },
   {
    "cell_type": "markdown",
    "metadata": {},
@@ -1163,6 +1188,80 @@
     "train_sample_dl = torch.utils.data.DataLoader(train_sample_ds, batch_size=50)"
    ]
   },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Memory-mapped training data\n",
+    "\n",
+    "The cell above reads the CSV file with pandas, slices it into new arrays and then converts those into tensors, so the data is copied several times before the `TensorDataset` holds yet another copy. That is fine for `250` rows but it means that the full training set has to fit in memory.\n",
+    "\n",
+    "Instead, we can use the `.npy` files we saved earlier. The `ReviewMemmapDataset` below memory-maps them and hands out tensors which are views of the mapped rows, so nothing is read until a row is actually used. The `DataLoader` uses background worker processes which keep a few batches prepared ahead of time (`prefetch_factor`) and stay alive between epochs (`persistent_workers`), so the training loop does not have to wait for its input."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "class ReviewMemmapDataset(torch.utils.data.Dataset):\n",
+    "    \"\"\"Dataset of (length + review, label) rows read from memory-mapped .npy files.\"\"\"\n",
+    "    \n",
+    "    def __init__(self, data_dir, x_file='train_X.npy', y_file='train_y.npy'):\n",
+    "        self.x_path = os.path.join(data_dir, x_file)\n",
+    "        self.y_path = os.path.join(data_dir, y_file)\n",
+    "        \n",
+    "        # Only the header is read here, the files are mapped lazily by each worker process\n",
+    "        self.num_rows = np.load(self.x_path, mmap_mode='r').shape[0]\n",
+    "        self.X = None\n",
+    "        self.y = None\n",
+    "        \n",
+    "    def __len__(self):\n",
+    "        return self.num_rows\n",
+    "    \n",
+    "    def __getitem__(self, idx):\n",
+    "        if self.X is None:\n",
+    "            # A copy-on-write mapping gives us writable arrays (which torch.from_numpy expects)\n",
+    "            # without ever modifying the files on disk.\n",
+    "            self.X = np.load(self.x_path, mmap_mode='c')\n",
+    "            self.y = np.load(self.y_path, mmap_mode='c')\n",
+    "        return torch.from_numpy(self.X[idx]), torch.from_numpy(self.y[idx:idx + 1])[0]\n",
+    "\n",
+    "def make_review_loader(dataset, batch_size=50, shuffle=True, num_workers=None, prefetch_factor=4):\n",
+    "    \"\"\"Construct a DataLoader which prepares batches ahead of time in worker processes.\"\"\"\n",
+    "    \n",
+    "    if num_workers is None:\n",
+    "        # Leave a core for the training loop itself\n",
+    "        num_workers = max(1, min(4, (os.cpu_count() or 1) - 1))\n",
+    "    \n",
+    "    extra_args = {}\n",
+    "    if num_workers > 0:\n",
+    "        extra_args = dict(prefetch_factor=prefetch_factor, persistent_workers=True)\n",
+    "    \n",
+    "    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,\n",
+    "                                       num_workers=num_workers,\n",
+    "                                       pin_memory=torch.cuda.is_available(),\n",
+    "                                       **extra_args)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "train_mmap_ds = ReviewMemmapDataset(mmap_dir)\n",
+    "train_mmap_dl = make_review_loader(train_mmap_ds, batch_size=50)"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "`train_mmap_dl` can be passed to the `train()` method in place of `train_sample_dl`, in which case the size of the training set is limited by the available disk space rather than memory."
+   ]
+  },
   {
    "cell_type": "markdown",
    "metadata": {},
@@ -1235,6 +1334,436 @@
     "train(model, train_sample_dl, 5, optimizer, loss_fn, device)"
    ]
   },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Sparse embedding gradients\n",
+    "\n",
+    "Each batch only contains a small fraction of the words in our vocabulary, however, with a regular `nn.Embedding` the gradient of the embedding table is dense. As a result `Adam` updates its state for every row of the table at every step and the cost of an optimizer step grows with `vocab_size`.\n",
+    "\n",
+    "If we switch the embedding to sparse gradients, only the rows which appear in the batch receive a gradient. Sparse gradients are not supported by `Adam` so the embedding is handled by `SparseAdam` while the remaining parameters keep using `Adam`. The `MultiOptimizer` wrapper lets us pass both optimizers to the `train()` method written above without any changes."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "class MultiOptimizer(object):\n",
+    "    \"\"\"Wrap several optimizers so that they can be used as a single one.\"\"\"\n",
+    "    \n",
+    "    def __init__(self, *optimizers):\n",
+    "        self.optimizers = optimizers\n",
+    "        \n",
+    "    def zero_grad(self):\n",
+    "        for optimizer in self.optimizers:\n",
+    "            optimizer.zero_grad()\n",
+    "            \n",
+    "    def step(self):\n",
+    "        for optimizer in self.optimizers:\n",
+    "            optimizer.step()\n",
+    "\n",
+    "def sparse_embedding_optimizer(model, lr=0.001):\n",
+    "    \"\"\"Switch the embedding of `model` to sparse gradients and construct a matching optimizer.\"\"\"\n",
+    "    \n",
+    "    model.embedding.sparse = True\n",
+    "    \n",
+    "    embedding_params = list(model.embedding.parameters())\n",
+    "    other_params = [param for name, param in model.named_parameters() if not name.startswith('embedding.')]\n",
+    "    \n",
+    "    return MultiOptimizer(optim.SparseAdam(embedding_params, lr=lr), optim.Adam(other_params, lr=lr))"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "model = LSTMClassifier(32, 100, 5000).to(device)\n",
+    "optimizer = sparse_embedding_optimizer(model)\n",
+    "\n",
+    "train(model, train_sample_dl, 5, optimizer, loss_fn, device)"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "To see the difference we can time a few training steps on the same batch while increasing the size of the vocabulary. With a dense embedding the step time grows along with `vocab_size`, whereas with sparse gradients it stays roughly the same."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import time\n",
+    "\n",
+    "def time_train_step(model, optimizer, batch_X, batch_y, steps=10):\n",
+    "    \"\"\"Return the average time, in seconds, of a training step on a single batch.\"\"\"\n",
+    "    \n",
+    "    model.train()\n",
+    "    for step in range(steps + 1):\n",
+    "        if step == 1:\n",
+    "            # The first step is a warm up step and is not timed\n",
+    "            start = time.time()\n",
+    "        optimizer.zero_grad()\n",
+    "        loss = loss_fn(model.forward(batch_X), batch_y)\n",
+    "        loss.backward()\n",
+    "        optimizer.step()\n",
+    "        \n",
+    "    return (time.time() - start) / steps\n",
+    "\n",
+    "batch_X, batch_y = next(iter(train_sample_dl))\n",
+    "batch_X, batch_y = batch_X.to(device), batch_y.to(device)\n",
+    "\n",
+    "for vocab_size in [5000, 20000, 50000, 100000, 200000]:\n",
+    "    dense_model = LSTMClassifier(32, 100, vocab_size).to(device)\n",
+    "    dense_time = time_train_step(dense_model, optim.Adam(dense_model.parameters()), batch_X, batch_y)\n",
+    "    \n",
+    "    sparse_model = LSTMClassifier(32, 100, vocab_size).to(device)\n",
+    "    sparse_time = time_train_step(sparse_model, sparse_embedding_optimizer(sparse_model), batch_X, batch_y)\n",
+    "    \n",
+    "    print(\"vocab_size: {:>6}, dense: {:.1f} ms/step, sparse: {:.1f} ms/step\".format(\n",
+    "        vocab_size, dense_time * 1000, sparse_time * 1000))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Compiled model\n",
+    "\n",
+    "Every call to `forward` executes the transposes, slicing and indexing of `LSTMClassifier` one Python operation at a time. Compiling the model removes most of this overhead. The `compile_model` method below first tries `torch.compile` and, if that is not available or fails, traces the model with TorchScript. If neither works we simply keep using the original (eager) model.\n",
+    "\n",
+    "Tracing records the operations performed on an example input, so the `range(len(lengths))` indexing used in `LSTMClassifier` would fix the batch size of the traced model to that of the example. The `TraceableLSTMClassifier` wrapper performs the same computation (using the weights of the wrapped model) but selects the final outputs with `gather` instead, so that the traced model works for any batch size and review length."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import torch.nn as nn\n",
+    "\n",
+    "class TraceableLSTMClassifier(nn.Module):\n",
+    "    \"\"\"Computes the same output as the wrapped LSTMClassifier but can be traced for any batch size.\"\"\"\n",
+    "    \n",
+    "    def __init__(self, model):\n",
+    "        super(TraceableLSTMClassifier, self).__init__()\n",
+    "        self.model = model\n",
+    "        \n",
+    "    def forward(self, x):\n",
+    "        x = x.t()\n",
+    "        lengths = x[0,:]\n",
+    "        reviews = x[1:,:]\n",
+    "        embeds = self.model.embedding(reviews)\n",
+    "        lstm_out, _ = self.model.lstm(embeds)\n",
+    "        out = self.model.dense(lstm_out)\n",
+    "        # Pick the output at position lengths - 1 of each review. The remainder mimics negative\n",
+    "        # indexing, which is what LSTMClassifier does for reviews of length 0.\n",
+    "        last = torch.remainder(lengths - 1, reviews.size(0))\n",
+    "        out = out.gather(0, last.view(1, -1, 1))\n",
+    "        return self.model.sig(out.squeeze())\n",
+    "\n",
+    "def compile_model(model, example_input, method='auto'):\n",
+    "    \"\"\"Compile or trace `model`, falling back to the eager model if neither is possible.\"\"\"\n",
+    "    \n",
+    "    methods = ['compile', 'trace'] if method == 'auto' else [method]\n",
+    "    for method in methods:\n",
+    "        try:\n",
+    "            if method == 'compile':\n",
+    "                compiled = torch.compile(model)\n",
+    "            else:\n",
+    "                compiled = torch.jit.trace(TraceableLSTMClassifier(model), example_input)\n",
+    "            # Compilation may be deferred until the first call so make sure that the result runs\n",
+    "            compiled(example_input)\n",
+    "            return compiled\n",
+    "        except Exception as e:\n",
+    "            print(\"Unable to {} the model: {}\".format(method, e))\n",
+    "            \n",
+    "    print(\"Using the eager model.\")\n",
+    "    return model"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "model = LSTMClassifier(32, 100, 5000).to(device)\n",
+    "optimizer = optim.Adam(model.parameters())\n",
+    "compiled_model = compile_model(model, batch_X)\n",
+    "\n",
+    "# The compiled model shares its parameters with `model`, so training it also trains `model`\n",
+    "train(compiled_model, train_sample_dl, 5, optimizer, loss_fn, device)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "eager_time = time_train_step(model, optim.Adam(model.parameters()), batch_X, batch_y)\n",
+    "compiled_time = time_train_step(compiled_model, optim.Adam(model.parameters()), batch_X, batch_y)\n",
+    "\n",
+    "print(\"Training step, eager: {:.1f} ms, compiled: {:.1f} ms\".format(eager_time * 1000, compiled_time * 1000))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Gradient checkpointing\n",
+    "\n",
+    "During training, the activations of every one of the `500` LSTM steps are kept in memory until the backward pass. For larger batches or a larger `hidden_dim` this quickly adds up and limits the batch size that fits on a small instance.\n",
+    "\n",
+    "`CheckpointedLSTMClassifier` splits each review into segments of `segment_size` words. Only the LSTM state at the segment boundaries (and the output of each review's final word) is kept in memory. The activations inside a segment are recomputed during the backward pass, which trades some extra computation for a much smaller amount of memory. It computes the same output as the `LSTMClassifier` it wraps and trains the same parameters, so it can be passed to `train()` in place of the model."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import torch.utils.checkpoint\n",
+    "\n",
+    "class CheckpointedLSTMClassifier(nn.Module):\n",
+    "    \"\"\"Computes the same output as the wrapped LSTMClassifier, recomputing activations during backward.\"\"\"\n",
+    "    \n",
+    "    def __init__(self, model, segment_size=50):\n",
+    "        super(CheckpointedLSTMClassifier, self).__init__()\n",
+    "        self.model = model\n",
+    "        self.segment_size = segment_size\n",
+    "        \n",
+    "    def _run_segment(self, reviews, last, start, h, c):\n",
+    "        embeds = self.model.embedding(reviews)\n",
+    "        lstm_out, (h, c) = self.model.lstm(embeds, (h, c))\n",
+    "        # Keep only the outputs of the reviews whose final word lies in this segment\n",
+    "        ends_here = (last >= start) & (last < start + reviews.size(0))\n",
+    "        position = (last - start).clamp(0, reviews.size(0) - 1)\n",
+    "        selected = lstm_out.gather(0, position.view(1, -1, 1).expand(1, -1, lstm_out.size(2))).squeeze(0)\n",
+    "        return selected * ends_here.unsqueeze(1).to(selected.dtype), h, c\n",
+    "        \n",
+    "    def forward(self, x):\n",
+    "        x = x.t()\n",
+    "        lengths = x[0,:]\n",
+    "        reviews = x[1:,:]\n",
+    "        last = torch.remainder(lengths - 1, reviews.size(0))\n",
+    "        \n",
+    "        weight = self.model.embedding.weight\n",
+    "        h = torch.zeros(1, reviews.size(1), self.model.lstm.hidden_size, dtype=weight.dtype, device=weight.device)\n",
+    "        c = torch.zeros_like(h)\n",
+    "        \n",
+    "        final = 0\n",
+    "        for start in range(0, reviews.size(0), self.segment_size):\n",
+    "            segment = reviews[start:start + self.segment_size]\n",
+    "            selected, h, c = torch.utils.checkpoint.checkpoint(self._run_segment, segment, last, start, h, c,\n",
+    "                                                               use_reentrant=False)\n",
+    "            final = final + selected\n",
+    "            \n",
+    "        out = self.model.dense(final)\n",
+    "        return self.model.sig(out.squeeze())"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "To decide on a segment size we measure the time taken by a training step together with the memory used by the activations. On a GPU we can simply measure the peak amount of memory allocated during the step. On the CPU we instead add up the tensors which are kept from the forward pass for the backward pass. In the checkpointed case this does not include the activations of the one segment which is being recomputed at any point during the backward pass."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "def measure_train_step(model, batch_X, batch_y):\n",
+    "    \"\"\"Return the time of a training step and the number of bytes used by the activations.\"\"\"\n",
+    "    \n",
+    "    param_storage = set(param.untyped_storage().data_ptr() for param in model.parameters())\n",
+    "    saved_storage = {}\n",
+    "    \n",
+    "    def pack(tensor):\n",
+    "        storage = tensor.untyped_storage()\n",
+    "        if storage.data_ptr() not in param_storage:\n",
+    "            saved_storage[storage.data_ptr()] = storage.nbytes()\n",
+    "        return tensor\n",
+    "    \n",
+    "    if batch_X.is_cuda:\n",
+    "        torch.cuda.reset_peak_memory_stats()\n",
+    "        memory_before = torch.cuda.memory_allocated()\n",
+    "    \n",
+    "    model.train()\n",
+    "    start = time.time()\n",
+    "    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):\n",
+    "        loss = loss_fn(model(batch_X), batch_y)\n",
+    "    loss.backward()\n",
+    "    step_time = time.time() - start\n",
+    "    \n",
+    "    if batch_X.is_cuda:\n",
+    "        return step_time, torch.cuda.max_memory_allocated() - memory_before\n",
+    "    return step_time, sum(saved_storage.values())\n",
+    "\n",
+    "model = LSTMClassifier(32, 200, 5000).to(device)\n",
+    "\n",
+    "step_time, activation_bytes = measure_train_step(model, batch_X, batch_y)\n",
+    "print(\"No checkpointing: {:6.1f} MB, {:.2f} s/step\".format(activation_bytes / 2**20, step_time))\n",
+    "\n",
+    "for segment_size in [250, 100, 50, 25]:\n",
+    "    step_time, activation_bytes = measure_train_step(CheckpointedLSTMClassifier(model, segment_size), batch_X, batch_y)\n",
+    "    print(\"Segment size {:>3}: {:6.1f} MB, {:.2f} s/step\".format(segment_size, activation_bytes / 2**20, step_time))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Local hyperparameter sweep\n",
+    "\n",
+    "Above we picked `LSTMClassifier(32, 100, 5000)` by hand and every configuration we want to try on SageMaker is a separate training job. To get a feel for which values of `embedding_dim`, `hidden_dim` and `vocab_size` are worth trying, we can instead run a small sweep on the notebook instance.\n",
+    "\n",
+    "`run_sweep` trains each configuration in its own process from a pool. Every process is limited to `threads_per_trial` threads and, optionally, `memory_per_trial` bytes of additional memory. The processes all memory-map the `.npy` files we saved in Step 3, so the encoded training data is read from disk once and shared through the page cache rather than copied into every process. The last `val_rows` rows are held out to compare the trials.\n",
+    "\n",
+    "Trials which are doing poorly are stopped early. After each epoch (past the first `grace_epochs`) a trial compares its validation loss with the median validation loss that the other trials had after the same epoch, and stops if it is worse. Finally, the results of all of the trials are written to `results_file`.\n",
+    "\n",
+    "Note that the `.npy` files were encoded using a vocabulary of `5000` words so `vocab_size` can be at most `5000`. Smaller vocabularies are simulated by treating the less frequent words as infrequent."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import itertools\n",
+    "import multiprocessing\n",
+    "import resource\n",
+    "\n",
+    "def limit_vocab(batch_X, vocab_size):\n",
+    "    \"\"\"Replace words outside of the `vocab_size` most frequent words by the 'infrequent' label.\"\"\"\n",
+    "    reviews = batch_X[:, 1:]\n",
+    "    reviews[reviews >= vocab_size] = 1\n",
+    "    return batch_X\n",
+    "\n",
+    "def evaluate(model, loader, vocab_size):\n",
+    "    \"\"\"Return the loss and accuracy of `model` on the data in `loader`.\"\"\"\n",
+    "    model.eval()\n",
+    "    total_loss, correct, count = 0.0, 0, 0\n",
+    "    with torch.no_grad():\n",
+    "        for batch_X, batch_y in loader:\n",
+    "            out = model(limit_vocab(batch_X, vocab_size))\n",
+    "            total_loss += loss_fn(out, batch_y).item() * len(batch_y)\n",
+    "            correct += (out.round() == batch_y).sum().item()\n",
+    "            count += len(batch_y)\n",
+    "    return total_loss / count, correct / count\n",
+    "\n",
+    "def limit_trial_resources(threads_per_trial, memory_per_trial):\n",
+    "    \"\"\"Restrict the number of threads and the amount of memory available to a sweep process.\"\"\"\n",
+    "    torch.set_num_threads(threads_per_trial)\n",
+    "    if memory_per_trial is not None:\n",
+    "        # The budget is on top of whatever the process (which is a fork of the notebook) already uses\n",
+    "        with open('/proc/self/status') as f:\n",
+    "            vm_size = [int(line.split()[1]) * 1024 for line in f if line.startswith('VmSize:')][0]\n",
+    "        resource.setrlimit(resource.RLIMIT_AS, (vm_size + memory_per_trial, resource.RLIM_INFINITY))\n",
+    "\n",
+    "def run_trial(trial, config, data_dir, epochs, history, batch_size=50, val_rows=1000, grace_epochs=2, min_trials=3):\n",
+    "    \"\"\"Train a single sweep configuration, stopping early if it falls behind the other trials.\"\"\"\n",
+    "    \n",
+    "    torch.manual_seed(trial)\n",
+    "    \n",
+    "    dataset = ReviewMemmapDataset(data_dir)\n",
+    "    rows = list(range(len(dataset)))\n",
+    "    train_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, rows[:-val_rows]),\n",
+    "                                               batch_size=batch_size, shuffle=True, drop_last=True)\n",
+    "    val_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, rows[-val_rows:]), batch_size=500)\n",
+    "    \n",
+    "    model = LSTMClassifier(config['embedding_dim'], config['hidden_dim'], config['vocab_size'])\n",
+    "    optimizer = optim.Adam(model.parameters())\n",
+    "    \n",
+    "    history[trial] = []\n",
+    "    status = 'completed'\n",
+    "    start = time.time()\n",
+    "    for epoch in range(1, epochs + 1):\n",
+    "        model.train()\n",
+    "        for batch_X, batch_y in train_loader:\n",
+    "            optimizer.zero_grad()\n",
+    "            loss = loss_fn(model(limit_vocab(batch_X, config['vocab_size'])), batch_y)\n",
+    "            loss.backward()\n",
+    "            optimizer.step()\n",
+    "            \n",
+    "        val_loss, val_accuracy = evaluate(model, val_loader, config['vocab_size'])\n",
+    "        history[trial] = history[trial] + [val_loss]\n",
+    "        \n",
+    "        # Median stopping rule: give up on this trial if it is worse than the median of the other\n",
+    "        # trials after the same number of epochs.\n",
+    "        others = [losses[epoch - 1] for other, losses in history.items() if other != trial and len(losses) >= epoch]\n",
+    "        if grace_epochs <= epoch < epochs and len(others) >= min_trials - 1 and val_loss > np.median(others):\n",
+    "            status = 'stopped'\n",
+    "            break\n",
+    "            \n",
+    "    return dict(config, trial=trial, status=status, epochs=epoch, val_loss=val_loss,\n",
+    "                val_accuracy=val_accuracy, seconds=time.time() - start)\n",
+    "\n",
+    "def run_sweep(configs, data_dir=mmap_dir, epochs=10, threads_per_trial=1, memory_per_trial=None,\n",
+    "              max_parallel=None, results_file='sweep_results.csv', batch_size=50, val_rows=1000,\n",
+    "              grace_epochs=2, min_trials=3):\n",
+    "    \"\"\"Train each of the `configs` in parallel and write a table of the results to `results_file`.\"\"\"\n",
+    "    \n",
+    "    num_rows = len(ReviewMemmapDataset(data_dir))\n",
+    "    if val_rows <= 0 or num_rows - val_rows < batch_size:\n",
+    "        raise Exception('Holding out {} of the {} rows leaves less than a batch of {} rows for training.'.format(\n",
+    "            val_rows, num_rows, batch_size))\n",
+    "    \n",
+    "    if max_parallel is None:\n",
+    "        max_parallel = max(1, multiprocessing.cpu_count() // threads_per_trial)\n",
+    "    \n",
+    "    # Forking lets the trial processes use the classes and methods defined in this notebook. Each trial gets\n",
+    "    # a fresh process so that the memory budget set by `limit_trial_resources` applies to that trial alone.\n",
+    "    context = multiprocessing.get_context('fork')\n",
+    "    history = context.Manager().dict()\n",
+    "    pool = context.Pool(max_parallel, limit_trial_resources, (threads_per_trial, memory_per_trial),\n",
+    "                        maxtasksperchild=1)\n",
+    "    \n",
+    "    pending = [(trial, config, pool.apply_async(run_trial, (trial, config, data_dir, epochs, history, batch_size,\n",
+    "                                                           val_rows, grace_epochs, min_trials)))\n",
+    "               for trial, config in enumerate(configs)]\n",
+    "    pool.close()\n",
+    "    \n",
+    "    results = []\n",
+    "    for trial, config, result in pending:\n",
+    "        try:\n",
+    "            results.append(result.get())\n",
+    "        except Exception as e:\n",
+    "            results.append(dict(config, trial=trial, status='failed: {}'.format(e), val_loss=np.nan))\n",
+    "    pool.join()\n",
+    "    \n",
+    "    results = pd.DataFrame(results).sort_values('val_loss')\n",
+    "    results.to_csv(results_file, index=False)\n",
+    "    return results"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "configs = [dict(embedding_dim=embedding_dim, hidden_dim=hidden_dim, vocab_size=vocab_size)\n",
+    "           for embedding_dim, hidden_dim, vocab_size in itertools.product([32, 64], [100, 200], [2500, 5000])]\n",
+    "\n",
+    "run_sweep(configs, epochs=5, threads_per_trial=1, memory_per_trial=2 * 2**30)"
+   ]
+  },
   {
    "cell_type": "markdown",
    "metadata": {},
@@ -1574,7 +2103,116 @@
    "cell_type": "markdown",
    "metadata": {},
    "source": [
-    "**Question:** How does this model compare to the XGBoost model you created earlier? Why might these two models perform differently on this dataset? Which do *you* think is better for sentiment analysis?"
+    "### (Optional) Sending the chunks concurrently\n",
+    "\n",
+    "The `predict` function above sends the chunks one at a time, so most of the time is spent waiting for the endpoint to respond, and `np.append` copies all of the predictions received so far for every chunk. The `predict_concurrently` function below instead sends several chunks at the same time, using at most `max_workers` threads, and writes the results of each chunk directly into its place in an array allocated up front. A chunk which fails because the endpoint is busy, because it takes too long to respond or because of a server error is sent again (up to `retries` times) after waiting a little. Any other error, such as a chunk which is too large or a `ModelError` returned when the inference code fails on the chunk, is raised straight away since sending the same chunk again would not help.\n",
+    "\n",
+    "Unless `rows` is given, the size of the chunks is chosen automatically: a first, small chunk is used to measure how long the endpoint takes per row, and the chunks are then made as large as possible while keeping each request under `target_latency` seconds and its payload, which is roughly the size of the rows as a NumPy array, under `max_payload` bytes (the endpoint does not accept payloads larger than 6 MB). The chunks are also kept small enough for every thread to have at least one chunk to send."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import concurrent.futures\n",
+    "import socket\n",
+    "import time\n",
+    "import urllib.error\n",
+    "\n",
+    "import botocore.exceptions\n",
+    "\n",
+    "# The error codes returned by the endpoint when it is (temporarily) unable to handle the request\n",
+    "RETRYABLE_ERROR_CODES = ['ThrottlingException', 'Throttling', 'TooManyRequestsException', 'ServiceUnavailable',\n",
+    "                         'InternalFailure', 'ModelNotReadyException']\n",
+    "\n",
+    "def is_retryable(error):\n",
+    "    \"\"\"Return whether a request which failed with `error` is worth sending again: throttling, timeouts and\n",
+    "    server errors are, invalid or too large requests are not.\"\"\"\n",
+    "    if isinstance(error, (socket.timeout, ConnectionError, botocore.exceptions.ConnectionError,\n",
+    "                          botocore.exceptions.HTTPClientError)):\n",
+    "        return True\n",
+    "    if isinstance(error, urllib.error.HTTPError):\n",
+    "        # Sent by a LocalEndpoint\n",
+    "        return error.code == 429 or error.code >= 500\n",
+    "    if isinstance(error, urllib.error.URLError):\n",
+    "        return isinstance(error.reason, (socket.timeout, ConnectionError))\n",
+    "    if isinstance(error, botocore.exceptions.ClientError):\n",
+    "        code = error.response.get('Error', {}).get('Code')\n",
+    "        if code == 'ModelError':\n",
+    "            # The inference code failed on this request. Its OriginalStatusCode is 500 for any exception,\n",
+    "            # including a request it can't handle, so sending the same request again would not help.\n",
+    "            return False\n",
+    "        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)\n",
+    "        return code in RETRYABLE_ERROR_CODES or status == 429 or status >= 500\n",
+    "    return False\n",
+    "\n",
+    "def send_with_retries(send_fn, chunk, retries=3, backoff=0.5):\n",
+    "    \"\"\"Return send_fn(chunk), retrying with an exponentially increasing delay if it fails with an error\n",
+    "    which is worth retrying.\"\"\"\n",
+    "    for attempt in range(retries + 1):\n",
+    "        try:\n",
+    "            return send_fn(chunk)\n",
+    "        except Exception as e:\n",
+    "            if attempt == retries or not is_retryable(e):\n",
+    "                raise\n",
+    "            print(\"Retrying a chunk after: {}\".format(e))\n",
+    "            time.sleep(backoff * 2 ** attempt)\n",
+    "\n",
+    "def predict_concurrently(data, send_fn=None, max_workers=8, rows=None, target_latency=1.0,\n",
+    "                         max_payload=5 * 1024 * 1024, probe_rows=64, retries=3):\n",
+    "    \"\"\"Return the predictions for `data`, sending up to `max_workers` chunks of `rows` rows at the same time.\"\"\"\n",
+    "    send_fn = send_fn or predictor.predict\n",
+    "    predictions = np.empty(len(data))\n",
+    "    if len(data) == 0:\n",
+    "        return predictions\n",
+    "    \n",
+    "    def send_chunk(begin, end):\n",
+    "        predictions[begin:end] = np.asarray(send_with_retries(send_fn, data[begin:end], retries)).reshape(-1)\n",
+    "    \n",
+    "    first = 0\n",
+    "    if rows is None:\n",
+    "        # Use a first, small chunk to measure the time and payload per row\n",
+    "        first = min(probe_rows, len(data))\n",
+    "        start = time.time()\n",
+    "        send_chunk(0, first)\n",
+    "        seconds_per_row = (time.time() - start) / max(first, 1)\n",
+    "        bytes_per_row = data[:first].nbytes / max(first, 1)\n",
+    "        rows = int(min(target_latency / max(seconds_per_row, 1e-9), max_payload / max(bytes_per_row, 1)))\n",
+    "        rows = max(1, min(rows, -(-(len(data) - first) // max_workers)))\n",
+    "    \n",
+    "    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:\n",
+    "        futures = [executor.submit(send_chunk, begin, min(begin + rows, len(data)))\n",
+    "                   for begin in range(first, len(data), rows)]\n",
+    "        for future in futures:\n",
+    "            future.result()\n",
+    "    \n",
+    "    return predictions"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "start = time.time()\n",
+    "predict(test_X.values)\n",
+    "print(\"predict: {:.1f} s\".format(time.time() - start))\n",
+    "\n",
+    "start = time.time()\n",
+    "predictions = predict_concurrently(test_X.values)\n",
+    "print(\"predict_concurrently: {:.1f} s\".format(time.time() - start))\n",
+    "\n",
+    "accuracy_score(test_y, [round(num) for num in predictions])"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "**Question:** How does this model compare to the XGBoost model you created earlier? Why might these two models perform differently on this dataset? Which do *you* think is better for sentiment analysis?"
    ]
   },
   {
@@ -2186,6 +2824,2456 @@
     "predictor.delete_endpoint()"
    ]
   },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "## Step 8 (optional): Running the inference code locally\n",
+    "\n",
+    "Deploying an endpoint takes several minutes and we are charged for as long as it is running. When experimenting with the inference code it is much more convenient to run it right here in the notebook. The sections below do not need a deployed endpoint, only the model artifacts created by the training job, so we begin by downloading and extracting them."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "model_dir = '../model' # The folder we will use for storing the model artifacts\n",
+    "if not os.path.exists(model_dir): # Make sure that the folder exists\n",
+    "    os.makedirs(model_dir)\n",
+    "\n",
+    "!aws s3 cp {estimator.model_data} {model_dir}/model.tar.gz\n",
+    "!tar -zxf {model_dir}/model.tar.gz -C {model_dir}"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "The cell below writes a new version of `serve/predict.py`, the inference code which we looked at in Step 6 (again). It contains the same `model_fn`, `input_fn`, `predict_fn` and `output_fn` functions, but `predict_fn` only runs the model over the words in the review rather than over all `500` positions, see below, and the file only imports what is needed to serve the model, see the section on the cold start time. The preprocessing is done by `strip_html` and `text_to_words`, which together do the same as `review_to_words` but can be timed separately, and `convert_and_pad` is imported from `serve/utils.py`.\n",
+    "\n",
+    "The cell after it imports `serve/predict.py`, so that the rest of the notebook uses exactly the inference code which is deployed, and the one after that defines a few helpers which are only used in the notebook.\n",
+    "\n",
+    "In addition, `model_fn` reads a few optional serving settings from `model_info.pth`, most of which use one of the helpers defined in `serve/predict.py`. The `update_model_info` method can be used to change them. To try a setting in the notebook without changing `model_info.pth`, it can also be passed to `model_fn` directly, as in `model_fn(model_dir, onnx=True)`.\n",
+    "\n",
+    " - `compile`: If `True` the model is compiled (or traced) using the `compile_model` method from Step 4.\n",
+    " - `quantize`: If `True` the weights of the model are quantized to int8 when running on the CPU.\n",
+    " - `onnx`: If `True` the model exported to `model.onnx` is run using ONNX Runtime instead of PyTorch.\n",
+    " - `max_batch_size`, `max_batch_wait`: If `max_batch_size` is larger than `1`, reviews from concurrent requests are combined into batches by a `MicroBatcher`.\n",
+    " - `num_threads`: The number of threads used by PyTorch. On the endpoint this defaults to the number of CPUs divided by the number of model server workers.\n",
+    " - `warmup`: Unless this is `False`, a review is sent through `predict_fn` before `model_fn` returns.\n",
+    " - `metrics_log_interval`: The number of seconds between the latency metrics being logged, or `None` to disable the log.\n",
+    " - `session_cache_size`, `session_ttl`: If `session_cache_size` is larger than `0`, the LSTM state of up to that many sessions is kept in a `SessionStateCache` for `session_ttl` seconds.\n",
+    " - `cascade`: If `True`, the reviews which the bag-of-words model saved by `save_cascade` is confident about are not run through the LSTM.\n",
+    " - `cache_size`, `cache_ttl`: If `cache_size` is larger than `0`, the results of up to `cache_size` bytes worth of reviews are kept in a `PredictionCache` for `cache_ttl` seconds."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "%%writefile serve/predict.py\n",
+    "import bisect\n",
+    "import collections\n",
+    "import concurrent.futures\n",
+    "import contextlib\n",
+    "import hashlib\n",
+    "import io\n",
+    "import json\n",
+    "import os\n",
+    "import pickle\n",
+    "import queue\n",
+    "import re\n",
+    "import sys\n",
+    "import threading\n",
+    "import time\n",
+    "import zlib\n",
+    "\n",
+    "import nltk\n",
+    "import numpy as np\n",
+    "import torch\n",
+    "import torch.nn as nn\n",
+    "from bs4 import BeautifulSoup\n",
+    "from nltk.corpus import stopwords\n",
+    "from nltk.stem.porter import PorterStemmer\n",
+    "\n",
+    "from model import LSTMClassifier\n",
+    "\n",
+    "from utils import convert_and_pad\n",
+    "\n",
+    "# The same preprocessing as review_to_words, in two stages so that each of them can be timed separately\n",
+    "\n",
+    "def strip_html(review):\n",
+    "    return BeautifulSoup(review, \"html.parser\").get_text() # Remove HTML tags\n",
+    "\n",
+    "def text_to_words(text):\n",
+    "    nltk.download(\"stopwords\", quiet=True)\n",
+    "    stemmer = PorterStemmer()\n",
+    "    \n",
+    "    text = re.sub(r\"[^a-zA-Z0-9]\", \" \", text.lower()) # Convert to lower case\n",
+    "    words = text.split() # Split string into words\n",
+    "    words = [w for w in words if w not in stopwords.words(\"english\")] # Remove stopwords\n",
+    "    words = [PorterStemmer().stem(w) for w in words] # stem\n",
+    "    \n",
+    "    return words\n",
+    "\n",
+    "# The compile setting uses the same compile_model method as Step 4\n",
+    "\n",
+    "class TraceableLSTMClassifier(nn.Module):\n",
+    "    \"\"\"Computes the same output as the wrapped LSTMClassifier but can be traced for any batch size.\"\"\"\n",
+    "    \n",
+    "    def __init__(self, model):\n",
+    "        super(TraceableLSTMClassifier, self).__init__()\n",
+    "        self.model = model\n",
+    "        \n",
+    "    def forward(self, x):\n",
+    "        x = x.t()\n",
+    "        lengths = x[0,:]\n",
+    "        reviews = x[1:,:]\n",
+    "        embeds = self.model.embedding(reviews)\n",
+    "        lstm_out, _ = self.model.lstm(embeds)\n",
+    "        out = self.model.dense(lstm_out)\n",
+    "        # Pick the output at position lengths - 1 of each review. The remainder mimics negative\n",
+    "        # indexing, which is what LSTMClassifier does for reviews of length 0.\n",
+    "        last = torch.remainder(lengths - 1, reviews.size(0))\n",
+    "        out = out.gather(0, last.view(1, -1, 1))\n",
+    "        return self.model.sig(out.squeeze())\n",
+    "\n",
+    "def compile_model(model, example_input, method='auto'):\n",
+    "    \"\"\"Compile or trace `model`, falling back to the eager model if neither is possible.\"\"\"\n",
+    "    \n",
+    "    methods = ['compile', 'trace'] if method == 'auto' else [method]\n",
+    "    for method in methods:\n",
+    "        try:\n",
+    "            if method == 'compile':\n",
+    "                compiled = torch.compile(model)\n",
+    "            else:\n",
+    "                compiled = torch.jit.trace(TraceableLSTMClassifier(model), example_input)\n",
+    "            # Compilation may be deferred until the first call so make sure that the result runs\n",
+    "            compiled(example_input)\n",
+    "            return compiled\n",
+    "        except Exception as e:\n",
+    "            print(\"Unable to {} the model: {}\".format(method, e))\n",
+    "            \n",
+    "    print(\"Using the eager model.\")\n",
+    "    return model\n",
+    "\n",
+    "def quantize_model(model):\n",
+    "    \"\"\"Quantize the weights of the LSTM and Linear layers of `model` to int8.\"\"\"\n",
+    "    return torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)\n",
+    "\n",
+    "class OnnxRuntimeModel(object):\n",
+    "    \"\"\"Run a model exported by `export_onnx` with ONNX Runtime, in place of the PyTorch model.\"\"\"\n",
+    "    \n",
+    "    def __init__(self, path):\n",
+    "        import onnxruntime\n",
+    "        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])\n",
+    "        self.word_dict = None\n",
+    "        \n",
+    "    def eval(self):\n",
+    "        return self\n",
+    "    \n",
+    "    def forward(self, x):\n",
+    "        score = self.session.run(None, {'x': x.cpu().numpy()})[0]\n",
+    "        return torch.from_numpy(score).squeeze()\n",
+    "    \n",
+    "    __call__ = forward\n",
+    "\n",
+    "def pack_reviews(reviews):\n",
+    "    \"\"\"Pack a list of (data_X, data_len) pairs into a single 'len, review[...]' array.\"\"\"\n",
+    "\n",
+    "    # The output of the model only depends on the words up to position data_len - 1, so there\n",
+    "    # is no need to run the LSTM over the padding after the longest review. An empty review\n",
+    "    # keeps all of its padding as the model uses the output at the very last position then.\n",
+    "    width = max(data_len for data_X, data_len in reviews)\n",
+    "    if min(data_len for data_X, data_len in reviews) == 0:\n",
+    "        width = max(len(data_X) for data_X, data_len in reviews)\n",
+    "\n",
+    "    data_pack = np.zeros((len(reviews), width + 1), dtype=np.int64)\n",
+    "    for row, (data_X, data_len) in enumerate(reviews):\n",
+    "        data_pack[row, 0] = data_len\n",
+    "        data_pack[row, 1:] = data_X[:width]\n",
+    "    return data_pack\n",
+    "\n",
+    "# Batches of reviews larger than this are run through the model in parts, to bound the memory used\n",
+    "MAX_FORWARD_ROWS = 512\n",
+    "\n",
+    "# The largest request body accepted once it has been decompressed\n",
+    "MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024\n",
+    "\n",
+    "# The largest number of processed reviews accepted in a single request\n",
+    "MAX_REVIEWS_PER_REQUEST = 10000\n",
+    "\n",
+    "class InvalidRequestError(Exception):\n",
+    "    \"\"\"A request which can't be handled because of the request itself, rather than a failure of the server.\"\"\"\n",
+    "    status_code = 400\n",
+    "\n",
+    "class UnsupportedFormatError(InvalidRequestError):\n",
+    "    \"\"\"A request with a content type which input_fn does not accept.\"\"\"\n",
+    "    status_code = 415\n",
+    "\n",
+    "def deserialize_reviews(body, media_type, parameters, pad=500):\n",
+    "    \"\"\"Return the `len, review[...]` rows in a request serialized by serialize_reviews.\"\"\"\n",
+    "    if 'compression=zlib' in parameters.replace(' ', ''):\n",
+    "        # The body comes from the client, so we don't decompress more than we are willing to process\n",
+    "        decompressor = zlib.decompressobj()\n",
+    "        body = decompressor.decompress(body, MAX_DECOMPRESSED_BYTES)\n",
+    "        if decompressor.unconsumed_tail:\n",
+    "            raise InvalidRequestError('The decompressed request is larger than {} bytes.'.format(MAX_DECOMPRESSED_BYTES))\n",
+    "        if not decompressor.eof:\n",
+    "            raise InvalidRequestError('The compressed request is incomplete.')\n",
+    "    if media_type in ['text/csv', 'application/x-npy']:\n",
+    "        if media_type == 'text/csv':\n",
+    "            data = np.loadtxt(io.StringIO(body.decode('utf-8')), delimiter=',', dtype=np.int64, ndmin=2)\n",
+    "        else:\n",
+    "            data = np.load(io.BytesIO(body), allow_pickle=False).astype(np.int64)\n",
+    "        if data.ndim != 2 or (len(data) > 0 and data.shape[1] < 2):\n",
+    "            raise InvalidRequestError('Expected a two dimensional array of len, review[...] rows.')\n",
+    "        if len(data) > MAX_REVIEWS_PER_REQUEST:\n",
+    "            raise InvalidRequestError('A request can contain at most {} reviews.'.format(MAX_REVIEWS_PER_REQUEST))\n",
+    "        if len(data) > 0 and ((data[:, 0] < 0) | (data[:, 0] > data.shape[1] - 1)).any():\n",
+    "            raise InvalidRequestError('The length of each review must be between 0 and the number of word ids in its row.')\n",
+    "        return data\n",
+    "\n",
+    "    if len(body) < 4:\n",
+    "        raise InvalidRequestError('The request is too short to contain the number of reviews.')\n",
+    "    count = int(np.frombuffer(body, dtype='<u4', count=1)[0])\n",
+    "    if count > MAX_REVIEWS_PER_REQUEST:\n",
+    "        raise InvalidRequestError('A request can contain at most {} reviews.'.format(MAX_REVIEWS_PER_REQUEST))\n",
+    "    if len(body) < 4 + 2 * count:\n",
+    "        raise InvalidRequestError('The request is too short to contain the lengths of {} reviews.'.format(count))\n",
+    "    lengths = np.frombuffer(body, dtype='<u2', count=count, offset=4).astype(np.int64)\n",
+    "    if count > 0 and lengths.max() > pad:\n",
+    "        raise InvalidRequestError('Reviews can be at most {} words long.'.format(pad))\n",
+    "    if len(body) != 4 + 2 * count + 2 * lengths.sum():\n",
+    "        raise InvalidRequestError('The request contains {} bytes of word ids, but the reviews are {} words long.'.format(\n",
+    "            len(body) - 4 - 2 * count, lengths.sum()))\n",
+    "    words = np.frombuffer(body, dtype='<u2', offset=4 + 2 * count).astype(np.int64)\n",
+    "    # Only an empty review needs the padding, see pack_reviews\n",
+    "    width = lengths.max() if count > 0 and lengths.min() > 0 else pad\n",
+    "    data = np.zeros((count, width + 1), dtype=np.int64)\n",
+    "    data[:, 0] = lengths\n",
+    "    begin = 0\n",
+    "    for row, length in enumerate(lengths):\n",
+    "        data[row, 1:1 + length] = words[begin:begin + length]\n",
+    "        begin += length\n",
+    "    return data\n",
+    "\n",
+    "class MicroBatcher(object):\n",
+    "    \"\"\"Collect reviews from concurrent requests and run them through the model as one batch.\"\"\"\n",
+    "\n",
+    "    def __init__(self, model, max_batch_size=32, max_wait=0.005):\n",
+    "        self.model = model\n",
+    "        self.max_batch_size = max_batch_size\n",
+    "        self.max_wait = max_wait\n",
+    "        self.device = torch.device(\"cuda\" if torch.cuda.is_available() else \"cpu\")\n",
+    "        self.requests = queue.Queue()\n",
+    "        self.worker = threading.Thread(target=self._run, daemon=True)\n",
+    "        self.worker.start()\n",
+    "\n",
+    "    def predict(self, data_X, data_len):\n",
+    "        \"\"\"Return the output of the model for a single review once its batch has been processed.\"\"\"\n",
+    "        result = concurrent.futures.Future()\n",
+    "        self.requests.put((data_X, data_len, result))\n",
+    "        return result.result()\n",
+    "\n",
+    "    def close(self):\n",
+    "        self.requests.put(None)\n",
+    "\n",
+    "    def _next_batch(self):\n",
+    "        # Wait for the first request, then collect more until the batch is full or max_wait has passed\n",
+    "        batch = [self.requests.get()]\n",
+    "        deadline = time.time() + self.max_wait\n",
+    "        while batch[-1] is not None and len(batch) < self.max_batch_size:\n",
+    "            timeout = deadline - time.time()\n",
+    "            if timeout <= 0:\n",
+    "                break\n",
+    "            try:\n",
+    "                batch.append(self.requests.get(timeout=timeout))\n",
+    "            except queue.Empty:\n",
+    "                break\n",
+    "        return batch\n",
+    "\n",
+    "    def _run(self):\n",
+    "        while True:\n",
+    "            batch = self._next_batch()\n",
+    "            stop = batch[-1] is None\n",
+    "            batch = [request for request in batch if request is not None]\n",
+    "\n",
+    "            if len(batch) > 0:\n",
+    "                # Sort the reviews by length, longest first, and run them through the model together\n",
+    "                batch.sort(key=lambda request: request[1], reverse=True)\n",
+    "                try:\n",
+    "                    data = torch.from_numpy(pack_reviews([(data_X, data_len) for data_X, data_len, _ in batch]))\n",
+    "                    with torch.no_grad():\n",
+    "                        output = self.model.forward(data.to(self.device)).cpu().reshape(-1)\n",
+    "                    for row, (_, _, result) in enumerate(batch):\n",
+    "                        result.set_result(output[row])\n",
+    "                except Exception as e:\n",
+    "                    for _, _, result in batch:\n",
+    "                        result.set_exception(e)\n",
+    "\n",
+    "            if stop:\n",
+    "                break\n",
+    "\n",
+    "class PredictionCache(object):\n",
+    "    \"\"\"A bounded LRU cache of model outputs, keyed by a hash of the (normalized) review's word ids.\"\"\"\n",
+    "\n",
+    "    # Rough estimate of the memory used by the OrderedDict for each entry, besides the objects stored in it\n",
+    "    ENTRY_OVERHEAD = 100\n",
+    "\n",
+    "    def __init__(self, max_bytes=10 * 1024 * 1024, ttl=3600):\n",
+    "        self.max_bytes = max_bytes\n",
+    "        self.ttl = ttl\n",
+    "        self.entries = collections.OrderedDict()\n",
+    "        self.bytes = 0\n",
+    "        self.lock = threading.Lock()\n",
+    "        self.hits = 0\n",
+    "        self.misses = 0\n",
+    "        self.evictions = 0\n",
+    "        self.expirations = 0\n",
+    "\n",
+    "    @staticmethod\n",
+    "    def key(data_X, data_len):\n",
+    "        \"\"\"Return the cache key for a review converted by `convert_and_pad`.\"\"\"\n",
+    "        # Only the words up to data_len are used by the model, so the padding is not part of the key\n",
+    "        return hashlib.sha1(np.asarray(data_X[:data_len], dtype=np.int64).tobytes()).digest()\n",
+    "\n",
+    "    def _entry_size(self, key, entry):\n",
+    "        return sys.getsizeof(key) + sys.getsizeof(entry) + sum(sys.getsizeof(x) for x in entry) + self.ENTRY_OVERHEAD\n",
+    "\n",
+    "    def get(self, key):\n",
+    "        \"\"\"Return the cached output for `key`, or None if there is no (unexpired) entry.\"\"\"\n",
+    "        with self.lock:\n",
+    "            entry = self.entries.get(key)\n",
+    "            if entry is not None and entry[1] < time.monotonic():\n",
+    "                self._remove(key)\n",
+    "                self.expirations += 1\n",
+    "                entry = None\n",
+    "            if entry is None:\n",
+    "                self.misses += 1\n",
+    "                return None\n",
+    "            self.entries.move_to_end(key)\n",
+    "            self.hits += 1\n",
+    "            return entry[0]\n",
+    "\n",
+    "    def put(self, key, value):\n",
+    "        entry = (value, time.monotonic() + self.ttl)\n",
+    "        size = self._entry_size(key, entry)\n",
+    "        if size > self.max_bytes:\n",
+    "            return\n",
+    "        with self.lock:\n",
+    "            if key in self.entries:\n",
+    "                self._remove(key)\n",
+    "            self.entries[key] = entry\n",
+    "            self.bytes += size\n",
+    "            # Evict the least recently used entries until we are within the size limit again\n",
+    "            while self.bytes > self.max_bytes:\n",
+    "                self._remove(next(iter(self.entries)))\n",
+    "                self.evictions += 1\n",
+    "\n",
+    "    def _remove(self, key):\n",
+    "        entry = self.entries.pop(key)\n",
+    "        self.bytes -= self._entry_size(key, entry)\n",
+    "\n",
+    "    def clear(self):\n",
+    "        with self.lock:\n",
+    "            self.entries.clear()\n",
+    "            self.bytes = 0\n",
+    "\n",
+    "    def stats(self):\n",
+    "        \"\"\"Return the hit/miss counts and the current size of the cache.\"\"\"\n",
+    "        with self.lock:\n",
+    "            lookups = self.hits + self.misses\n",
+    "            return {'hits': self.hits, 'misses': self.misses,\n",
+    "                    'hit_rate': self.hits / lookups if lookups > 0 else 0.0,\n",
+    "                    'evictions': self.evictions, 'expirations': self.expirations,\n",
+    "                    'entries': len(self.entries), 'bytes': self.bytes}\n",
+    "\n",
+    "class LatencyMetrics(object):\n",
+    "    \"\"\"Latency histograms for each stage of handling a request, with an optional periodic log.\"\"\"\n",
+    "\n",
+    "    # Bucket boundaries, in seconds, spaced logarithmically from 1 microsecond up to 10 seconds\n",
+    "    BUCKETS = [10 ** (exponent / 20.0) for exponent in range(-120, 21)]\n",
+    "\n",
+    "    def __init__(self, log_interval=None):\n",
+    "        self.log_interval = log_interval\n",
+    "        self.lock = threading.Lock()\n",
+    "        self.reset()\n",
+    "\n",
+    "    def reset(self):\n",
+    "        with self.lock:\n",
+    "            self.counts = {}\n",
+    "            self.totals = {}\n",
+    "            self.last_log = time.time()\n",
+    "\n",
+    "    @contextlib.contextmanager\n",
+    "    def time(self, stage):\n",
+    "        \"\"\"Record the time spent in the body of the `with` statement for `stage`.\"\"\"\n",
+    "        start = time.perf_counter()\n",
+    "        try:\n",
+    "            yield\n",
+    "        finally:\n",
+    "            self.record(stage, time.perf_counter() - start)\n",
+    "\n",
+    "    def record(self, stage, seconds):\n",
+    "        bucket = bisect.bisect_left(self.BUCKETS, seconds)\n",
+    "        with self.lock:\n",
+    "            if stage not in self.counts:\n",
+    "                self.counts[stage] = [0] * (len(self.BUCKETS) + 1)\n",
+    "                self.totals[stage] = 0.0\n",
+    "            self.counts[stage][bucket] += 1\n",
+    "            self.totals[stage] += seconds\n",
+    "\n",
+    "    def _percentile(self, counts, q):\n",
+    "        # The upper bound of the bucket containing the q-th quantile, the last bucket has no upper bound\n",
+    "        target = q * sum(counts)\n",
+    "        seen = 0\n",
+    "        for bucket, count in enumerate(counts):\n",
+    "            seen += count\n",
+    "            if count > 0 and seen >= target:\n",
+    "                return self.BUCKETS[min(bucket, len(self.BUCKETS) - 1)]\n",
+    "\n",
+    "    def snapshot(self):\n",
+    "        \"\"\"Return the number of requests and the mean, p50, p95 and p99 latency, in ms, of each stage.\"\"\"\n",
+    "        with self.lock:\n",
+    "            result = {}\n",
+    "            for stage, counts in self.counts.items():\n",
+    "                count = sum(counts)\n",
+    "                result[stage] = {'count': count,\n",
+    "                                 'mean_ms': 1000 * self.totals[stage] / count,\n",
+    "                                 'p50_ms': 1000 * self._percentile(counts, 0.50),\n",
+    "                                 'p95_ms': 1000 * self._percentile(counts, 0.95),\n",
+    "                                 'p99_ms': 1000 * self._percentile(counts, 0.99)}\n",
+    "            return result\n",
+    "\n",
+    "    def maybe_log(self):\n",
+    "        \"\"\"Print a snapshot, as a single line of JSON, if log_interval seconds have passed since the last one.\"\"\"\n",
+    "        if self.log_interval is None or time.time() - self.last_log < self.log_interval:\n",
+    "            return\n",
+    "        self.last_log = time.time()\n",
+    "        print(json.dumps({'latency_metrics': self.snapshot()}))\n",
+    "\n",
+    "# The input_fn, predict_fn and output_fn functions all record their timings here\n",
+    "metrics = LatencyMetrics()\n",
+    "\n",
+    "def available_cpus():\n",
+    "    \"\"\"Return the number of CPUs this process is allowed to run on.\"\"\"\n",
+    "    try:\n",
+    "        return len(os.sched_getaffinity(0))\n",
+    "    except AttributeError:\n",
+    "        return os.cpu_count() or 1\n",
+    "\n",
+    "def default_topology(num_workers=None):\n",
+    "    \"\"\"Return the number of worker processes and the number of PyTorch threads per worker to use.\"\"\"\n",
+    "    cpus = available_cpus()\n",
+    "    if num_workers is None:\n",
+    "        # Unless told otherwise, the model server starts one worker per CPU\n",
+    "        num_workers = int(os.environ.get('SAGEMAKER_MODEL_SERVER_WORKERS', cpus))\n",
+    "    return num_workers, max(1, cpus // num_workers)\n",
+    "\n",
+    "class SessionStateCache(object):\n",
+    "    \"\"\"Keep the LSTM state of the most recent review of each session, so that when the review is extended\n",
+    "    (as happens when a user is typing) only the new words need to be run through the model.\"\"\"\n",
+    "\n",
+    "    def __init__(self, model, max_sessions=10000, ttl=600):\n",
+    "        self.model = model\n",
+    "        self.max_sessions = max_sessions\n",
+    "        self.ttl = ttl\n",
+    "        self.device = torch.device(\"cuda\" if torch.cuda.is_available() else \"cpu\")\n",
+    "        self.entries = collections.OrderedDict()\n",
+    "        self.lock = threading.Lock()\n",
+    "        self.hits = 0\n",
+    "        self.misses = 0\n",
+    "        self.words_total = 0\n",
+    "        self.words_run = 0\n",
+    "\n",
+    "    def _run(self, words, state):\n",
+    "        # Run the words through the LSTM starting from `state`, and return the output at the last word\n",
+    "        embeds = self.model.embedding(torch.LongTensor(words).view(-1, 1).to(self.device))\n",
+    "        lstm_out, state = self.model.lstm(embeds, state)\n",
+    "        return self.model.sig(self.model.dense(lstm_out[-1]).squeeze()), state\n",
+    "\n",
+    "    def predict(self, session, data_X, data_len):\n",
+    "        \"\"\"Return the output of the model for a single (non-empty) review belonging to `session`.\"\"\"\n",
+    "        words = [int(word) for word in data_X[:data_len]]\n",
+    "        # The state is stored after all but the last word, since the last word may still be incomplete\n",
+    "        prefix = words[:-1]\n",
+    "\n",
+    "        with self.lock:\n",
+    "            entry = self.entries.pop(session, None)\n",
+    "        if entry is not None and entry[2] >= time.monotonic() and entry[0] == prefix[:len(entry[0])]:\n",
+    "            start, state = len(entry[0]), entry[1]\n",
+    "        else:\n",
+    "            start, state = 0, None\n",
+    "\n",
+    "        with torch.no_grad():\n",
+    "            if start < len(prefix):\n",
+    "                _, state = self._run(prefix[start:], state)\n",
+    "            output, _ = self._run(words[-1:], state)\n",
+    "\n",
+    "        with self.lock:\n",
+    "            self.entries[session] = (prefix, state, time.monotonic() + self.ttl)\n",
+    "            # Evict the least recently used sessions\n",
+    "            while len(self.entries) > self.max_sessions:\n",
+    "                self.entries.popitem(last=False)\n",
+    "            if start > 0:\n",
+    "                self.hits += 1\n",
+    "            else:\n",
+    "                self.misses += 1\n",
+    "            self.words_total += len(words)\n",
+    "            self.words_run += len(words) - start\n",
+    "\n",
+    "        return output\n",
+    "\n",
+    "    def stats(self):\n",
+    "        with self.lock:\n",
+    "            return {'hits': self.hits, 'misses': self.misses, 'sessions': len(self.entries),\n",
+    "                    'words_total': self.words_total, 'words_run': self.words_run}\n",
+    "\n",
+    "class BagOfWordsCascade(object):\n",
+    "    \"\"\"A linear bag-of-words model which answers, in place of the LSTM, the reviews it is confident about.\"\"\"\n",
+    "\n",
+    "    def __init__(self, weights, bias, low, high):\n",
+    "        self.weights = np.asarray(weights, dtype=np.float32)\n",
+    "        self.bias = float(bias)\n",
+    "        self.low = low\n",
+    "        self.high = high\n",
+    "\n",
+    "    def score(self, data_X, data_len):\n",
+    "        \"\"\"Return the probability that a review converted by `convert_and_pad` is positive.\"\"\"\n",
+    "        words = np.unique(np.asarray(data_X[:data_len]))\n",
+    "        return 1.0 / (1.0 + np.exp(-(self.bias + self.weights[words].sum())))\n",
+    "\n",
+    "    def predict(self, data_X, data_len):\n",
+    "        \"\"\"Return the score of the review if it is at most `low` or at least `high`, otherwise None.\"\"\"\n",
+    "        score = self.score(data_X, data_len)\n",
+    "        return float(score) if score <= self.low or score >= self.high else None\n",
+    "\n",
+    "def load_model_artifacts(model_dir):\n",
+    "    \"\"\"Return the model_info, model parameters and word_dict stored in `model_dir`. The model parameters are\n",
+    "    returned as they are stored, see dequantize_embedding.\"\"\"\n",
+    "\n",
+    "    bundle_path = os.path.join(model_dir, 'model_bundle.pth')\n",
+    "    if os.path.exists(bundle_path):\n",
+    "        # Everything is stored in a single file, see save_model_bundle.\n",
+    "        with open(bundle_path, 'rb') as f:\n",
+    "            bundle = torch.load(f)\n",
+    "        return bundle['model_info'], bundle['state_dict'], pickle.loads(bundle['word_dict'])\n",
+    "\n",
+    "    # Otherwise, we use the separate files written by the training script.\n",
+    "    model_info_path = os.path.join(model_dir, 'model_info.pth')\n",
+    "    with open(model_info_path, 'rb') as f:\n",
+    "        model_info = torch.load(f)\n",
+    "\n",
+    "    model_path = os.path.join(model_dir, 'model.pth')\n",
+    "    with open(model_path, 'rb') as f:\n",
+    "        state_dict = torch.load(f)\n",
+    "\n",
+    "    word_dict_path = os.path.join(model_dir, 'word_dict.pkl')\n",
+    "    with open(word_dict_path, 'rb') as f:\n",
+    "        word_dict = pickle.load(f)\n",
+    "\n",
+    "    return model_info, state_dict, word_dict\n",
+    "\n",
+    "def dequantize_embedding(state_dict):\n",
+    "    \"\"\"Replace an int8 embedding table, as written by compress_artifacts, by the float32 table it represents.\"\"\"\n",
+    "    if 'embedding.weight_int8' in state_dict:\n",
+    "        state_dict = dict(state_dict)\n",
+    "        scale = state_dict.pop('embedding.weight_scale')\n",
+    "        state_dict['embedding.weight'] = state_dict.pop('embedding.weight_int8').float() * scale.view(-1, 1)\n",
+    "    return state_dict\n",
+    "\n",
+    "def model_fn(model_dir, **settings):\n",
+    "    \"\"\"Load the PyTorch model from the `model_dir` directory. Any serving `settings` given take precedence over\n",
+    "    those in `model_info.pth`, without changing the file.\"\"\"\n",
+    "    print(\"Loading model.\")\n",
+    "\n",
+    "    # First, load the parameters used to create the model, the model parameters and the word_dict.\n",
+    "    model_info, state_dict, word_dict = load_model_artifacts(model_dir)\n",
+    "    model_info = dict(model_info, **settings)\n",
+    "\n",
+    "    print(\"model_info: {}\".format(model_info))\n",
+    "\n",
+    "    # Determine the device and construct the model.\n",
+    "    device = torch.device(\"cuda\" if torch.cuda.is_available() else \"cpu\")\n",
+    "\n",
+    "    # Each model server worker gets its share of the CPUs, rather than PyTorch using a thread per CPU in\n",
+    "    # every worker. In the notebook the number of threads is only changed if num_threads is set.\n",
+    "    num_threads = model_info.get('num_threads')\n",
+    "    if num_threads is None and 'SAGEMAKER_PROGRAM' in os.environ:\n",
+    "        num_threads = default_topology()[1]\n",
+    "    if num_threads is not None:\n",
+    "        torch.set_num_threads(num_threads)\n",
+    "\n",
+    "    if model_info.get('onnx', False):\n",
+    "        # The exported model replaces the PyTorch model entirely.\n",
+    "        model = OnnxRuntimeModel(os.path.join(model_dir, 'model.onnx'))\n",
+    "    else:\n",
+    "        model = LSTMClassifier(model_info['embedding_dim'], model_info['hidden_dim'], model_info['vocab_size'])\n",
+    "        model.load_state_dict(dequantize_embedding(state_dict))\n",
+    "        model.to(device).eval()\n",
+    "\n",
+    "        quantized = model_info.get('quantize', False) and device.type == 'cpu'\n",
+    "        if quantized:\n",
+    "            model = quantize_model(model)\n",
+    "\n",
+    "        # The session cache runs the layers of the model directly, so it uses the model before compilation.\n",
+    "        sessions = None\n",
+    "        if model_info.get('session_cache_size', 0) > 0:\n",
+    "            sessions = SessionStateCache(model, model_info['session_cache_size'], model_info.get('session_ttl', 600))\n",
+    "\n",
+    "        if model_info.get('compile', False):\n",
+    "            # A review of length one, which is all that is needed to compile the model.\n",
+    "            example_input = torch.LongTensor([[1, 1]]).to(device)\n",
+    "            with torch.no_grad():\n",
+    "                model = compile_model(model, example_input)\n",
+    "\n",
+    "        model.sessions = sessions\n",
+    "\n",
+    "    model.word_dict = word_dict\n",
+    "\n",
+    "    model.cascade = None\n",
+    "    if model_info.get('cascade', False):\n",
+    "        # The bag-of-words model and its thresholds, see save_cascade\n",
+    "        with open(os.path.join(model_dir, 'cascade.pth'), 'rb') as f:\n",
+    "            model.cascade = BagOfWordsCascade(**torch.load(f))\n",
+    "\n",
+    "    if model_info.get('max_batch_size', 1) > 1:\n",
+    "        model.batcher = MicroBatcher(model, model_info['max_batch_size'], model_info.get('max_batch_wait', 0.005))\n",
+    "\n",
+    "    # Periodically log the latency of each stage, as the requests themselves are not logged\n",
+    "    metrics.log_interval = model_info.get('metrics_log_interval', 60)\n",
+    "\n",
+    "    if model_info.get('warmup', True):\n",
+    "        # Send a review through predict_fn so that the first real request does not have to pay for\n",
+    "        # any lazy initialization, such as loading the stopwords or compiling the model. The warmup\n",
+    "        # review is not a request, so it should not show up in the latency metrics.\n",
+    "        predict_fn('This movie was great.', model)\n",
+    "        metrics.reset()\n",
+    "\n",
+    "    if model_info.get('cache_size', 0) > 0:\n",
+    "        # The cache belongs to this model, so loading a new model always starts with an empty cache. It is\n",
+    "        # attached after the warmup, which would otherwise be its first entry.\n",
+    "        model.cache = PredictionCache(model_info['cache_size'], model_info.get('cache_ttl', 3600))\n",
+    "\n",
+    "    print(\"Done loading model.\")\n",
+    "    return model\n",
+    "\n",
+    "def input_fn(serialized_input_data, content_type):\n",
+    "    with metrics.time('decode'):\n",
+    "        try:\n",
+    "            return decode_input(serialized_input_data, content_type)\n",
+    "        except ValueError as e:\n",
+    "            # A body which is not valid UTF-8, JSON, CSV or .npy data\n",
+    "            raise InvalidRequestError('Unable to decode the input: {}'.format(e))\n",
+    "\n",
+    "def decode_input(serialized_input_data, content_type):\n",
+    "    media_type, _, parameters = content_type.partition(';')\n",
+    "    media_type = media_type.strip()\n",
+    "    if media_type == 'text/plain':\n",
+    "        data = serialized_input_data.decode('utf-8')\n",
+    "        if 'format=lines' in parameters.replace(' ', ''):\n",
+    "            # One review per line\n",
+    "            return [line for line in data.splitlines() if line.strip()]\n",
+    "        return data\n",
+    "    if media_type == 'application/json':\n",
+    "        # Either a single review or an array of reviews\n",
+    "        data = json.loads(serialized_input_data.decode('utf-8'))\n",
+    "        if isinstance(data, str) or (isinstance(data, list) and all(isinstance(review, str) for review in data)):\n",
+    "            return data\n",
+    "        if isinstance(data, dict) and isinstance(data.get('session'), str) and isinstance(data.get('review'), str):\n",
+    "            # A review which is being typed, see SessionStateCache\n",
+    "            return data\n",
+    "        raise InvalidRequestError('Expected a review, an array of reviews or a session and review in the JSON input.')\n",
+    "    if media_type in ['application/jsonlines', 'application/x-ndjson']:\n",
+    "        # One JSON encoded review per line\n",
+    "        data = serialized_input_data.decode('utf-8')\n",
+    "        data = [json.loads(line) for line in data.splitlines() if line.strip()]\n",
+    "        if not all(isinstance(review, str) for review in data):\n",
+    "            raise InvalidRequestError('Expected a JSON encoded review on each line of the input.')\n",
+    "        return data\n",
+    "    if media_type in ['text/csv', 'application/x-npy', 'application/x-review-ids']:\n",
+    "        # Reviews which have already been converted into word ids, see serialize_reviews\n",
+    "        return deserialize_reviews(serialized_input_data, media_type, parameters)\n",
+    "    raise UnsupportedFormatError('Requested unsupported ContentType in content_type: ' + content_type)\n",
+    "\n",
+    "def output_fn(prediction_output, accept):\n",
+    "    with metrics.time('serialize'):\n",
+    "        if np.ndim(prediction_output) > 0:\n",
+    "            # The results for a batch of reviews are returned as a JSON array, in the same order\n",
+    "            result = json.dumps(prediction_output.tolist())\n",
+    "        else:\n",
+    "            result = str(prediction_output)\n",
+    "    metrics.maybe_log()\n",
+    "    return result\n",
+    "\n",
+    "def predict_fn(input_data, model):\n",
+    "    device = torch.device(\"cuda\" if torch.cuda.is_available() else \"cpu\")\n",
+    "    \n",
+    "    if model.word_dict is None:\n",
+    "        raise Exception('Model has not been loaded properly, no word_dict.')\n",
+    "    \n",
+    "    session = None\n",
+    "    if isinstance(input_data, dict):\n",
+    "        session, input_data = input_data['session'], input_data['review']\n",
+    "\n",
+    "    # A single review is processed as a batch containing one review\n",
+    "    is_batch = isinstance(input_data, (list, np.ndarray))\n",
+    "    if not is_batch:\n",
+    "        input_data = [input_data]\n",
+    "    if len(input_data) == 0:\n",
+    "        return np.array([])\n",
+    "    \n",
+    "    if isinstance(input_data, np.ndarray):\n",
+    "        # The reviews have already been converted into 'len, review[...]' rows, using the word ids of this model\n",
+    "        vocab_size = len(model.word_dict) + 2\n",
+    "        if input_data[:, 1:].min() < 0 or input_data[:, 1:].max() >= vocab_size:\n",
+    "            raise InvalidRequestError('The word ids must be between 0 and {}.'.format(vocab_size - 1))\n",
+    "        reviews = [(row[1:], int(row[0])) for row in input_data]\n",
+    "    else:\n",
+    "        with metrics.time('html'):\n",
+    "            texts = [strip_html(review) for review in input_data]\n",
+    "        with metrics.time('words'):\n",
+    "            sentences = [text_to_words(text) for text in texts]\n",
+    "        with metrics.time('encode'):\n",
+    "            reviews = [convert_and_pad(model.word_dict, sentence) for sentence in sentences]\n",
+    "\n",
+    "    cache = getattr(model, 'cache', None)\n",
+    "    if cache is not None:\n",
+    "        # Look up each review in the cache, the model only needs to process the others\n",
+    "        keys = [cache.key(data_X, data_len) for data_X, data_len in reviews]\n",
+    "        outputs = [cache.get(key) for key in keys]\n",
+    "    else:\n",
+    "        outputs = [None] * len(reviews)\n",
+    "    missing = [i for i, output in enumerate(outputs) if output is None]\n",
+    "\n",
+    "    todo = missing\n",
+    "    if getattr(model, 'cascade', None) is not None:\n",
+    "        # The reviews the bag-of-words model is confident about don't need to be run through the LSTM\n",
+    "        with metrics.time('cascade'):\n",
+    "            for i in missing:\n",
+    "                outputs[i] = model.cascade.predict(*reviews[i])\n",
+    "        todo = [i for i in missing if outputs[i] is None]\n",
+    "\n",
+    "    if len(todo) > 0:\n",
+    "        if session is not None and getattr(model, 'sessions', None) is not None and reviews[0][1] > 0:\n",
+    "            # Only run the words which have been added since the session's previous review\n",
+    "            with metrics.time('forward'):\n",
+    "                output = model.sessions.predict(session, *reviews[0])\n",
+    "        elif not is_batch and getattr(model, 'batcher', None) is not None:\n",
+    "            # Let the batcher combine this review with those of any concurrent requests\n",
+    "            with metrics.time('forward'):\n",
+    "                output = model.batcher.predict(*reviews[0])\n",
+    "        else:\n",
+    "            # Make sure to put the model into evaluation mode\n",
+    "            model.eval()\n",
+    "\n",
+    "            output = []\n",
+    "            for begin in range(0, len(todo), MAX_FORWARD_ROWS):\n",
+    "                # Using data_X and data_len of each review we construct an appropriate input tensor. Remember\n",
+    "                # that our model expects input data of the form 'len, review[...]'.\n",
+    "                with metrics.time('pack'):\n",
+    "                    data = torch.from_numpy(pack_reviews([reviews[i] for i in todo[begin:begin + MAX_FORWARD_ROWS]]))\n",
+    "                    data = data.to(device)\n",
+    "\n",
+    "                with metrics.time('forward'):\n",
+    "                    with torch.no_grad():\n",
+    "                        output.append(model.forward(data).cpu().reshape(-1))\n",
+    "            output = torch.cat(output)\n",
+    "\n",
+    "        for i, value in zip(todo, output.cpu().numpy().reshape(-1)):\n",
+    "            outputs[i] = float(value)\n",
+    "\n",
+    "    if cache is not None:\n",
+    "        for i in missing:\n",
+    "            cache.put(keys[i], outputs[i])\n",
+    "\n",
+    "    result = np.round(np.array(outputs, dtype=np.float32))\n",
+    "\n",
+    "    return result if is_batch else result[0]"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import importlib\n",
+    "import sys\n",
+    "\n",
+    "# The rest of the notebook uses the inference code in serve/predict.py, imported in the same way as the endpoint\n",
+    "# does. The serve directory also contains the model.py and utils.py files which it imports.\n",
+    "if 'serve' not in sys.path:\n",
+    "    sys.path.insert(0, 'serve')\n",
+    "if 'predict' in sys.modules:\n",
+    "    # Pick up the changes if the cell above has been run again\n",
+    "    importlib.reload(sys.modules['predict'])\n",
+    "\n",
+    "from predict import (BagOfWordsCascade, MicroBatcher, available_cpus, default_topology, dequantize_embedding, input_fn,\n",
+    "                     load_model_artifacts, metrics, model_fn, output_fn, pack_reviews, predict_fn, quantize_model)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "# Helpers which are only used in the notebook, the endpoint only needs serve/predict.py\n",
+    "import concurrent.futures\n",
+    "import io\n",
+    "import json\n",
+    "import multiprocessing\n",
+    "import threading\n",
+    "import time\n",
+    "import zlib\n",
+    "\n",
+    "import torch.nn as nn\n",
+    "\n",
+    "def serialize_reviews(data, content_type='application/x-review-ids', compress=False):\n",
+    "    \"\"\"Serialize `len, review[...]` rows, such as test_X.values, in one of the formats accepted by input_fn.\n",
+    "    Returns the body and the content type of the request.\"\"\"\n",
+    "    data = np.asarray(data)\n",
+    "    if content_type == 'text/csv':\n",
+    "        buffer = io.BytesIO()\n",
+    "        np.savetxt(buffer, data, fmt='%d', delimiter=',')\n",
+    "        body = buffer.getvalue()\n",
+    "    elif content_type in ['application/x-npy', 'application/x-review-ids']:\n",
+    "        if data.size > 0 and (data.min() < 0 or data.max() > 65535):\n",
+    "            raise Exception('The lengths and word ids must fit in 16 bits.')\n",
+    "        if content_type == 'application/x-npy':\n",
+    "            buffer = io.BytesIO()\n",
+    "            np.save(buffer, data.astype(np.uint16))\n",
+    "            body = buffer.getvalue()\n",
+    "        else:\n",
+    "            # The number of reviews, the length of each review and then the word ids of all of the reviews\n",
+    "            lengths = data[:, 0]\n",
+    "            words = [row[1:1 + length] for row, length in zip(data, lengths)]\n",
+    "            body = (np.array([len(data)], dtype='<u4').tobytes() + lengths.astype('<u2').tobytes()\n",
+    "                    + np.concatenate(words + [np.zeros(0)]).astype('<u2').tobytes())\n",
+    "    else:\n",
+    "        raise Exception('Unsupported content type: ' + content_type)\n",
+    "    if compress:\n",
+    "        body = zlib.compress(body)\n",
+    "        content_type += '; compression=zlib'\n",
+    "    return body, content_type\n",
+    "\n",
+    "# The model used by the processes of a WorkerPool, loaded before they are forked, and the module (if\n",
+    "# any) containing the inference code.\n",
+    "_worker_model = None\n",
+    "_worker_handlers = None\n",
+    "\n",
+    "def _init_worker(num_threads):\n",
+    "    torch.set_num_threads(num_threads)\n",
+    "\n",
+    "def _invoke(body, content_type, accept):\n",
+    "    handlers = _worker_handlers\n",
+    "    if handlers is None:\n",
+    "        return output_fn(predict_fn(input_fn(body, content_type), _worker_model), accept)\n",
+    "    return handlers.output_fn(handlers.predict_fn(handlers.input_fn(body, content_type), _worker_model), accept)\n",
+    "\n",
+    "class WorkerPool(object):\n",
+    "    \"\"\"Load the model once and fork worker processes which share it (and the word_dict) copy-on-write.\"\"\"\n",
+    "\n",
+    "    def __init__(self, model_dir, num_workers=None, num_threads=None, handlers=None):\n",
+    "        global _worker_model, _worker_handlers\n",
+    "        default_workers, default_threads = default_topology(num_workers)\n",
+    "        self.num_workers = num_workers or default_workers\n",
+    "        self.num_threads = num_threads or default_threads\n",
+    "\n",
+    "        # By default the inference code defined in this notebook is used\n",
+    "        _worker_handlers = handlers\n",
+    "        _worker_model = (handlers.model_fn if handlers is not None else model_fn)(model_dir)\n",
+    "        if getattr(_worker_model, 'batcher', None) is not None:\n",
+    "            # The thread of the batcher would not exist in the forked processes\n",
+    "            _worker_model.batcher.close()\n",
+    "            _worker_model.batcher = None\n",
+    "\n",
+    "        context = multiprocessing.get_context('fork')\n",
+    "        self.pool = context.Pool(self.num_workers, _init_worker, (self.num_threads,))\n",
+    "\n",
+    "    def invoke(self, body, content_type='text/plain', accept='text/plain'):\n",
+    "        \"\"\"Handle a single request in one of the worker processes and return the serialized result.\"\"\"\n",
+    "        return self.pool.apply(_invoke, (body, content_type, accept))\n",
+    "\n",
+    "    def close(self):\n",
+    "        self.pool.close()\n",
+    "        self.pool.join()\n",
+    "\n",
+    "def save_model_bundle(model_dir):\n",
+    "    \"\"\"Combine model_info.pth, model.pth and word_dict.pkl into a single model_bundle.pth file.\"\"\"\n",
+    "\n",
+    "    model_info, state_dict, word_dict = load_model_artifacts(model_dir)\n",
+    "\n",
+    "    # The word_dict is stored already pickled, since torch.load is a lot slower at unpickling a large dict.\n",
+    "    bundle_path = os.path.join(model_dir, 'model_bundle.pth')\n",
+    "    with open(bundle_path, 'wb') as f:\n",
+    "        torch.save(dict(model_info=model_info, state_dict=state_dict, word_dict=pickle.dumps(word_dict)), f)\n",
+    "\n",
+    "def save_model_artifacts(out_dir, model_info, state_dict, word_dict):\n",
+    "    \"\"\"Write `model_info`, the model parameters and `word_dict` to `out_dir` as a new set of model artifacts.\"\"\"\n",
+    "    if not os.path.exists(out_dir):\n",
+    "        os.makedirs(out_dir)\n",
+    "    with open(os.path.join(out_dir, 'model_info.pth'), 'wb') as f:\n",
+    "        torch.save(model_info, f)\n",
+    "    with open(os.path.join(out_dir, 'model.pth'), 'wb') as f:\n",
+    "        torch.save(state_dict, f)\n",
+    "    with open(os.path.join(out_dir, 'word_dict.pkl'), 'wb') as f:\n",
+    "        pickle.dump(word_dict, f)\n",
+    "\n",
+    "    # A bundle left over from earlier would take precedence over these files\n",
+    "    bundle_path = os.path.join(out_dir, 'model_bundle.pth')\n",
+    "    if os.path.exists(bundle_path):\n",
+    "        os.remove(bundle_path)\n",
+    "\n",
+    "def update_model_info(model_dir, **settings):\n",
+    "    \"\"\"Add (or change) the given serving settings in the `model_info.pth` file in `model_dir`.\"\"\"\n",
+    "    \n",
+    "    model_info_path = os.path.join(model_dir, 'model_info.pth')\n",
+    "    with open(model_info_path, 'rb') as f:\n",
+    "        model_info = torch.load(f)\n",
+    "    \n",
+    "    model_info.update(settings)\n",
+    "    \n",
+    "    with open(model_info_path, 'wb') as f:\n",
+    "        torch.save(model_info, f)\n",
+    "\n",
+    "    # Keep the bundle, if there is one, up to date as well.\n",
+    "    bundle_path = os.path.join(model_dir, 'model_bundle.pth')\n",
+    "    if os.path.exists(bundle_path):\n",
+    "        with open(bundle_path, 'rb') as f:\n",
+    "            bundle = torch.load(f)\n",
+    "        bundle['model_info'].update(settings)\n",
+    "        with open(bundle_path, 'wb') as f:\n",
+    "            torch.save(bundle, f)\n",
+    "        \n",
+    "    return model_info"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "local_model = model_fn(model_dir)\n",
+    "\n",
+    "output_fn(predict_fn(input_fn(test_review.encode('utf-8'), 'text/plain'), local_model), 'text/plain')"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Compiled model for inference\n",
+    "\n",
+    "When the endpoint receives a single review the model only performs a small amount of work, so the Python overhead of running the model in eager mode is a large part of the time spent in `predict_fn`. Below we compare the time taken by a forward pass of the eager and the compiled model for a single review and for a batch of `50` reviews."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "def time_forward(model, data, repeats=20):\n",
+    "    \"\"\"Return the average time, in seconds, of a forward pass of `model` on `data`.\"\"\"\n",
+    "    \n",
+    "    with torch.no_grad():\n",
+    "        model(data) # Warm up\n",
+    "        start = time.time()\n",
+    "        for _ in range(repeats):\n",
+    "            model(data)\n",
+    "    return (time.time() - start) / repeats\n",
+    "\n",
+    "eager_model = model_fn(model_dir, compile=False)\n",
+    "compiled_local_model = model_fn(model_dir, compile=True)\n",
+    "\n",
+    "for batch_size in [1, 50]:\n",
+    "    data = torch.from_numpy(test_X.values[:batch_size]).to(device)\n",
+    "    print(\"Batch size: {:>2}, eager: {:.2f} ms, compiled: {:.2f} ms\".format(\n",
+    "        batch_size, time_forward(eager_model, data) * 1000, time_forward(compiled_local_model, data) * 1000))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Quantized model for inference\n",
+    "\n",
+    "The endpoint runs the model on the CPU using float32 weights. With dynamic quantization the weights of the LSTM and Linear layers are stored as int8 and the activations are quantized on the fly during inference. This makes the model smaller and, depending on the CPU and the version of PyTorch, faster at the cost of some precision.\n",
+    "\n",
+    "Before we enable quantization for the endpoint we need to make sure that it doesn't hurt the accuracy of the model too much. The `quantization_gate` method below compares the quantized and float models on the test set and only sets `quantize` in `model_info.pth` if the accuracy drops by no more than `max_accuracy_drop`. Otherwise it refuses and the model is served as before. It also prints the size and latency of both models so that we can check that quantization is worth it on our instance type."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import io\n",
+    "\n",
+    "def model_outputs(model, data_X, batch_size=500):\n",
+    "    \"\"\"Return the output of `model` (on the CPU) for each of the `len, review[500]` rows in `data_X`.\"\"\"\n",
+    "    \n",
+    "    outputs = []\n",
+    "    with torch.no_grad():\n",
+    "        for start in range(0, len(data_X), batch_size):\n",
+    "            batch = torch.from_numpy(data_X[start:start + batch_size])\n",
+    "            outputs.append(model(batch).cpu().numpy().reshape(-1))\n",
+    "    return np.concatenate(outputs)\n",
+    "\n",
+    "def evaluate_accuracy(model, data_X, data_y, batch_size=500):\n",
+    "    \"\"\"Return the accuracy of `model` (on the CPU) on the `len, review[500]` rows in `data_X`.\"\"\"\n",
+    "    \n",
+    "    predictions = np.round(model_outputs(model, data_X, batch_size))\n",
+    "    \n",
+    "    return (predictions == np.array(data_y)).mean()\n",
+    "\n",
+    "def model_size(model):\n",
+    "    \"\"\"Return the number of bytes taken by the saved parameters of `model`.\"\"\"\n",
+    "    buffer = io.BytesIO()\n",
+    "    torch.save(model.state_dict(), buffer)\n",
+    "    return buffer.tell()\n",
+    "\n",
+    "def quantization_gate(model_dir, data_X, data_y, max_accuracy_drop=0.005):\n",
+    "    \"\"\"Enable the quantized model in `model_dir` only if it is about as accurate as the float model.\"\"\"\n",
+    "    \n",
+    "    update_model_info(model_dir, quantize=False)\n",
+    "    # The plain float model, whatever other serving settings are enabled in model_info.pth\n",
+    "    float_model = model_fn(model_dir, quantize=False, compile=False, onnx=False, max_batch_size=1, cache_size=0,\n",
+    "                           session_cache_size=0, warmup=False).cpu()\n",
+    "    quantized_model = quantize_model(float_model)\n",
+    "    \n",
+    "    float_accuracy = evaluate_accuracy(float_model, data_X, data_y)\n",
+    "    quantized_accuracy = evaluate_accuracy(quantized_model, data_X, data_y)\n",
+    "    \n",
+    "    single_review = torch.from_numpy(data_X[:1])\n",
+    "    print(\"float:     accuracy {:.4f}, size {:.2f} MB, latency {:.2f} ms\".format(\n",
+    "        float_accuracy, model_size(float_model) / 2**20, time_forward(float_model, single_review) * 1000))\n",
+    "    print(\"quantized: accuracy {:.4f}, size {:.2f} MB, latency {:.2f} ms\".format(\n",
+    "        quantized_accuracy, model_size(quantized_model) / 2**20, time_forward(quantized_model, single_review) * 1000))\n",
+    "    \n",
+    "    if float_accuracy - quantized_accuracy > max_accuracy_drop:\n",
+    "        raise Exception('Quantization reduces the accuracy by {:.4f}, refusing to enable it.'.format(\n",
+    "            float_accuracy - quantized_accuracy))\n",
+    "    \n",
+    "    return update_model_info(model_dir, quantize=True)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "quantization_gate(model_dir, test_X.values, test_y)"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) ONNX Runtime backend\n",
+    "\n",
+    "Another way of getting the overhead of PyTorch out of the way is to export the model to [ONNX](https://onnx.ai/) and run it with ONNX Runtime, which is also much smaller to install than PyTorch. The model is exported by tracing it, so we use the `TraceableLSTMClassifier` wrapper from Step 4. The batch size and review length are exported as dynamic dimensions so that the exported model accepts the same `len, review[...]` input as `LSTMClassifier` for any number of reviews.\n",
+    "\n",
+    "Once `model.onnx` has been written to the model directory, setting `onnx` makes `model_fn` return an `OnnxRuntimeModel` which `predict_fn` can use in exactly the same way as the PyTorch model."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import inspect\n",
+    "\n",
+    "class OnnxLSTMClassifier(TraceableLSTMClassifier):\n",
+    "    \"\"\"TraceableLSTMClassifier which returns one score per review, even for a batch of one.\"\"\"\n",
+    "    \n",
+    "    def forward(self, x):\n",
+    "        return super(OnnxLSTMClassifier, self).forward(x).view(-1)\n",
+    "\n",
+    "def export_onnx(model, path, opset_version=14):\n",
+    "    \"\"\"Export `model` to an ONNX graph with a dynamic batch size and review length.\"\"\"\n",
+    "    \n",
+    "    # Two short `len, review[...]` rows, only the shape and type matter for the export\n",
+    "    example_input = torch.LongTensor([[3, 2, 3, 4], [2, 5, 6, 0]])\n",
+    "    \n",
+    "    extra_args = {}\n",
+    "    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:\n",
+    "        # Newer versions of PyTorch default to a different exporter, we want the tracing one.\n",
+    "        extra_args['dynamo'] = False\n",
+    "    \n",
+    "    torch.onnx.export(OnnxLSTMClassifier(model.cpu().eval()), example_input, path,\n",
+    "                      input_names=['x'], output_names=['score'],\n",
+    "                      dynamic_axes={'x': {0: 'batch', 1: 'length'}, 'score': {0: 'batch'}},\n",
+    "                      opset_version=opset_version, **extra_args)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "# Export the plain float32 model\n",
+    "torch_model = model_fn(model_dir, quantize=False, compile=False, onnx=False).cpu()\n",
+    "export_onnx(torch_model, os.path.join(model_dir, 'model.onnx'))\n",
+    "\n",
+    "# Only the models loaded here use ONNX Runtime, model_info.pth is left as it is\n",
+    "onnx_model = model_fn(model_dir, onnx=True)"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "Before using the exported model we check that it produces the same results as the PyTorch model for a single review, for batches of reviews and for reviews of a different length than the example used for the export."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "with torch.no_grad():\n",
+    "    for data in [test_X.values[:1], test_X.values[:64], test_X.values[:64, :101]]:\n",
+    "        data = np.array(data)\n",
+    "        data[:, 0] = np.minimum(data[:, 0], data.shape[1] - 1)\n",
+    "        np.testing.assert_allclose(onnx_model(torch.from_numpy(data)).numpy(),\n",
+    "                                   torch_model(torch.from_numpy(data)).numpy(), rtol=1e-4, atol=1e-5)\n",
+    "\n",
+    "print(\"The ONNX model matches the PyTorch model.\")"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "for batch_size in [1, 8, 64]:\n",
+    "    data = torch.from_numpy(test_X.values[:batch_size])\n",
+    "    print(\"Batch size: {:>2}, PyTorch: {:.2f} ms, ONNX Runtime: {:.2f} ms\".format(\n",
+    "        batch_size, time_forward(torch_model, data) * 1000, time_forward(onnx_model, data) * 1000))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Skipping the padding\n",
+    "\n",
+    "Most of the reviews typed into the web app are only a few dozen words long, yet the original `predict_fn` pads every review to `500` words and the LSTM processes all `500` positions. Since the LSTM reads the review from left to right, the output at position `data_len - 1`, which is the one the model returns, does not depend on anything that comes after it. So `pack_reviews`, which `predict_fn` uses to construct the input for the model, cuts the padding off.\n",
+    "\n",
+    "Below we check that this gives the same results as running the model over the padded reviews and compare the time taken by the model for a short review."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "# The plain PyTorch LSTMClassifier, which is what predict_fn uses unless one of the other settings is enabled\n",
+    "check_model = model_fn(model_dir, quantize=False, compile=False, onnx=False)\n",
+    "\n",
+    "with torch.no_grad():\n",
+    "    for row in test_X.values[:500]:\n",
+    "        length = row[0]\n",
+    "        if length == 0:\n",
+    "            continue # Empty reviews are not trimmed\n",
+    "        padded_output = check_model(torch.from_numpy(row.reshape(1, -1)))\n",
+    "        trimmed_output = check_model(torch.from_numpy(row[:length + 1].reshape(1, -1)))\n",
+    "        assert torch.allclose(padded_output, trimmed_output, rtol=1e-5, atol=1e-6)\n",
+    "\n",
+    "print(\"Trimming the padding does not change the output of the model.\")"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "words = review_to_words(test_review)\n",
+    "data_X, data_len = convert_and_pad(check_model.word_dict, words)\n",
+    "\n",
+    "padded_data = torch.from_numpy(np.hstack((data_len, data_X)).reshape(1, -1))\n",
+    "trimmed_data = torch.from_numpy(np.hstack((data_len, data_X[:data_len])).reshape(1, -1))\n",
+    "\n",
+    "print(\"Review length: {}, padded: {:.2f} ms, trimmed: {:.2f} ms\".format(\n",
+    "    data_len, time_forward(check_model, padded_data) * 1000, time_forward(check_model, trimmed_data) * 1000))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Micro-batching concurrent requests\n",
+    "\n",
+    "Each request is processed on its own, so when many requests arrive at the same time the model is run many times on a batch containing a single review. Running the model once on a batch of reviews is much cheaper than running it once for each review.\n",
+    "\n",
+    "When `max_batch_size` is set in `model_info.pth`, `model_fn` attaches a `MicroBatcher` to the model. Rather than running the model itself, `predict_fn` hands the encoded review to the batcher and waits for the result. The batcher collects the reviews of concurrent requests until it has `max_batch_size` of them or `max_batch_wait` seconds have passed since the first one arrived. It then sorts them by length, runs the model once on the whole batch and hands each request its own result. Note that this only helps if the server handles several requests at once in the same process using threads.\n",
+    "\n",
+    "On the other hand, when there is only a single client each of its requests waits `max_batch_wait` seconds for company, so micro-batching only pays off under concurrent load.\n",
+    "\n",
+    "To see the effect we send encoded test reviews to the model from a number of threads at the same time, once directly and once through a `MicroBatcher`."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "def run_concurrently(fn, items, concurrency):\n",
+    "    \"\"\"Call `fn` on each of `items` from `concurrency` threads and return the number of calls per second.\"\"\"\n",
+    "    start = time.time()\n",
+    "    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:\n",
+    "        list(executor.map(fn, items))\n",
+    "    return len(items) / (time.time() - start)\n",
+    "\n",
+    "# The plain PyTorch model, as in the previous section\n",
+    "batch_model = model_fn(model_dir, quantize=False, compile=False, onnx=False)\n",
+    "batcher = MicroBatcher(batch_model, max_batch_size=32, max_wait=0.005)\n",
+    "\n",
+    "def predict_single(review):\n",
+    "    with torch.no_grad():\n",
+    "        return batch_model(torch.from_numpy(pack_reviews([review])))\n",
+    "\n",
+    "reviews = [(row[1:], row[0]) for row in test_X.values[:2000]]\n",
+    "\n",
+    "for concurrency in [1, 8, 32]:\n",
+    "    print(\"Concurrency: {:>2}, one at a time: {:6.1f} reviews/s, micro-batched: {:6.1f} reviews/s\".format(\n",
+    "        concurrency, run_concurrently(predict_single, reviews, concurrency),\n",
+    "        run_concurrently(lambda review: batcher.predict(*review), reviews, concurrency)))\n",
+    "\n",
+    "batcher.close()"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Sending many reviews in one request\n",
+    "\n",
+    "Clients which need to score a large number of reviews would otherwise have to send one request per review. Besides a single `text/plain` review, `input_fn` above also accepts several reviews in a single request, which `predict_fn` then processes as one padded batch:\n",
+    "\n",
+    " - `application/json`: A JSON array of reviews.\n",
+    " - `application/jsonlines` (or `application/x-ndjson`): One JSON encoded review per line.\n",
+    " - `text/plain; format=lines`: One plain text review per line. Note that the reviews must not contain line breaks themselves.\n",
+    "\n",
+    "For these requests `output_fn` returns a JSON array with the result for each review, in the same order as the reviews in the request."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "batch_reviews = [test_review, 'This movie was terrible, the acting was wooden and the plot made no sense.', '']\n",
+    "\n",
+    "for content_type, body in [('application/json', json.dumps(batch_reviews)),\n",
+    "                           ('application/jsonlines', '\\n'.join(json.dumps(review) for review in batch_reviews)),\n",
+    "                           ('text/plain; format=lines', '\\n'.join(batch_reviews[:2]))]:\n",
+    "    print(content_type, output_fn(predict_fn(input_fn(body.encode('utf-8'), content_type), local_model), 'application/json'))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Reducing the cold start time\n",
+    "\n",
+    "When the endpoint is started (or scaled out) each new container has to import the inference code and call `model_fn` before it can answer its first request, and the first request itself is usually slower than the ones that follow. There are a few things we can do about this.\n",
+    "\n",
+    "First, the inference code should only import what it actually needs. The `serve/predict.py` file we looked at in Step 6 also imports `sagemaker_containers`, `pandas`, `argparse`, `torch.optim` and `torch.utils.data`, none of which are used when serving. The version written above only imports the standard library, `numpy` and `torch`, together with `nltk` and `BeautifulSoup` for the preprocessing, and `onnxruntime` is only imported if the ONNX backend is enabled.\n",
+    "\n",
+    "Second, `model_fn` reads three separate files, `model_info.pth`, `model.pth` and `word_dict.pkl`. Using `save_model_bundle` we can combine these into a single `model_bundle.pth` file, which `model_fn` (through `load_model_artifacts`) uses instead whenever it is present. Note that `update_model_info` keeps the settings stored in the bundle up to date.\n",
+    "\n",
+    "Lastly, unless the `warmup` setting is `False`, `model_fn` sends a short review through `predict_fn` before returning so that the cost of any lazy initialization, such as loading the stopwords, allocating memory or compiling the model, is paid while the container is starting instead of by the first request.\n",
+    "\n",
+    "Since the notebook has already imported everything, the times below understate the difference in a freshly started container."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "update_model_info(model_dir, quantize=False, compile=False, onnx=False, max_batch_size=1)\n",
+    "\n",
+    "def time_cold_start(model_dir, warmup, repeats=5):\n",
+    "    \"\"\"Return the average time, in seconds, taken by model_fn and by the first request afterwards.\"\"\"\n",
+    "    update_model_info(model_dir, warmup=warmup)\n",
+    "\n",
+    "    load_time, first_time = 0, 0\n",
+    "    for _ in range(repeats):\n",
+    "        start = time.time()\n",
+    "        model = model_fn(model_dir)\n",
+    "        load_time += time.time() - start\n",
+    "\n",
+    "        start = time.time()\n",
+    "        predict_fn(test_review, model)\n",
+    "        first_time += time.time() - start\n",
+    "\n",
+    "    return load_time / repeats, first_time / repeats\n",
+    "\n",
+    "bundle_path = os.path.join(model_dir, 'model_bundle.pth')\n",
+    "\n",
+    "for bundle in [False, True]:\n",
+    "    if bundle:\n",
+    "        save_model_bundle(model_dir)\n",
+    "    elif os.path.exists(bundle_path):\n",
+    "        os.remove(bundle_path)\n",
+    "\n",
+    "    for warmup in [False, True]:\n",
+    "        load_time, first_time = time_cold_start(model_dir, warmup)\n",
+    "        print(\"Bundle: {}, warmup: {}, model_fn: {:.1f} ms, first request: {:.1f} ms\".format(\n",
+    "            bundle, warmup, load_time * 1000, first_time * 1000))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "#### Deploying the inference code\n",
+    "\n",
+    "The serving settings, and the bundle, are only stored in our local copy of the model artifacts. To use them on an endpoint we package the model directory again, upload it to S3 and deploy it together with the new `serve/predict.py`, in the same way as in Step 6 (again). Note that if the `onnx` setting is used, `onnxruntime` also has to be added to `serve/requirements.txt`."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import tarfile\n",
+    "\n",
+    "def package_model(model_dir, path):\n",
+    "    \"\"\"Write the model artifacts in `model_dir`, including the serving settings and the bundle, to `path`.\"\"\"\n",
+    "    with tarfile.open(path, 'w:gz') as tar:\n",
+    "        for name in sorted(os.listdir(model_dir)):\n",
+    "            # Leave out the archive downloaded from the training job\n",
+    "            if name != 'model.tar.gz':\n",
+    "                tar.add(os.path.join(model_dir, name), arcname=name)\n",
+    "\n",
+    "package_model(model_dir, '../model_serving.tar.gz')\n",
+    "serving_model_data = sagemaker_session.upload_data(path='../model_serving.tar.gz', bucket=bucket,\n",
+    "                                                   key_prefix=prefix + '/serving')\n",
+    "\n",
+    "serving_model = PyTorchModel(model_data=serving_model_data,\n",
+    "                             role = role,\n",
+    "                             framework_version='0.4.0',\n",
+    "                             entry_point='predict.py',\n",
+    "                             source_dir='serve',\n",
+    "                             predictor_cls=StringPredictor)\n",
+    "serving_predictor = serving_model.deploy(initial_instance_count=1, instance_type='ml.m4.xlarge')\n",
+    "\n",
+    "print(serving_predictor.predict(test_review))\n",
+    "\n",
+    "# As before, make sure to shut down the endpoint when it is no longer needed\n",
+    "serving_predictor.delete_endpoint()"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Caching the results of repeated reviews\n",
+    "\n",
+    "A noticeable fraction of the reviews the endpoint receives are duplicates, for example when a user submits the same review twice from the web app or when a batch job is run again. Since the model is deterministic there is no need to process these again. If the `cache_size` setting is larger than `0`, `model_fn` attaches a `PredictionCache` to the model and `predict_fn` only runs the model on the reviews which are not in the cache.\n",
+    "\n",
+    "The cache is keyed by a hash of the word ids produced by `convert_and_pad`, so reviews which only differ in ways that `review_to_words` removes (such as case, punctuation and html tags) share the same entry. Entries expire after `cache_ttl` seconds and, once the cache holds more than `cache_size` bytes, the least recently used entries are evicted. Since the cache is created by `model_fn`, deploying (or loading) a new model always starts with an empty cache."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "cached_model = model_fn(model_dir, cache_size=1024 * 1024, cache_ttl=3600)\n",
+    "\n",
+    "# The same review with different case and punctuation maps to the same cache entry\n",
+    "for review in [test_review, test_review.upper(), test_review + '!!!']:\n",
+    "    start = time.time()\n",
+    "    result = predict_fn(review, cached_model)\n",
+    "    print(\"Result: {}, time: {:.2f} ms\".format(result, (time.time() - start) * 1000))\n",
+    "\n",
+    "print(cached_model.cache.stats())"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Where does the time go?\n",
+    "\n",
+    "Before optimizing the inference code any further we should know which part of handling a request takes the most time. Instead of printing a line for every request, `input_fn`, `predict_fn` and `output_fn` record how long each stage takes in the `metrics` object:\n",
+    "\n",
+    " - `decode`: Decoding the body of the request in `input_fn`.\n",
+    " - `html`: Removing the html tags from the reviews (`strip_html`).\n",
+    " - `words`: Converting the text into a list of stemmed words, without stopwords (`text_to_words`).\n",
+    " - `encode`: Converting the words into word ids (`convert_and_pad`).\n",
+    " - `pack`: Constructing the input tensor from the word ids (`pack_reviews`).\n",
+    " - `forward`: Running the model. When micro-batching is enabled this includes the time spent waiting for the batch.\n",
+    " - `serialize`: Serializing the result in `output_fn`.\n",
+    "\n",
+    "For each stage the latencies are stored in a histogram, from which `metrics.snapshot()` estimates the 50th, 95th and 99th percentile. On the endpoint these are printed as a single line of JSON, which ends up in CloudWatch, every `metrics_log_interval` seconds."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "metrics.reset()\n",
+    "\n",
+    "for review in [test_review] + batch_reviews + [test_review.upper(), test_review * 10]:\n",
+    "    output_fn(predict_fn(input_fn(review.encode('utf-8'), 'text/plain'), local_model), 'text/plain')\n",
+    "\n",
+    "pd.DataFrame(metrics.snapshot()).T"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Worker processes and threads\n",
+    "\n",
+    "The model server on the endpoint starts several worker processes, by default one for each CPU, and each of them calls `model_fn`. Left alone, PyTorch would then use a thread per CPU in every worker, so that the workers end up competing for the same CPUs. For this reason `model_fn` sets the number of PyTorch threads to the number of CPUs divided by the number of workers, unless the `num_threads` setting says otherwise. The number of workers itself can be set using the `SAGEMAKER_MODEL_SERVER_WORKERS` environment variable when creating the model, for example\n",
+    "\n",
+    "```python\n",
+    "model = PyTorchModel(model_data=estimator.model_data,\n",
+    "                     ...,\n",
+    "                     env={'SAGEMAKER_MODEL_SERVER_WORKERS': '2'})\n",
+    "```\n",
+    "\n",
+    "Which combination works best depends on the instance type and on the requests, so below we try them out locally. The `WorkerPool` calls `model_fn` once and then forks the worker processes, so that the model parameters and the `word_dict` are shared by the workers (copy-on-write) instead of being loaded by each of them. Since we need actual reviews for this, we turn the reviews in the test set back into text using the `word_dict`."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "# Turn the (processed) test reviews back into text which we can send as requests\n",
+    "int_to_word = {idx: word for word, idx in local_model.word_dict.items()}\n",
+    "sample_requests = [' '.join(int_to_word.get(idx, '') for idx in row[1:row[0] + 1]).encode('utf-8')\n",
+    "                   for row in test_X.values[:1000]]\n",
+    "\n",
+    "def benchmark_topology(model_dir, requests, num_workers, num_threads, concurrency):\n",
+    "    \"\"\"Return the throughput, in requests per second, and the median and 99th percentile latency.\"\"\"\n",
+    "    pool = WorkerPool(model_dir, num_workers, num_threads)\n",
+    "    latencies = []\n",
+    "\n",
+    "    def send(body):\n",
+    "        start = time.time()\n",
+    "        pool.invoke(body)\n",
+    "        latencies.append(time.time() - start)\n",
+    "\n",
+    "    throughput = run_concurrently(send, requests, concurrency)\n",
+    "    pool.close()\n",
+    "    return throughput, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000\n",
+    "\n",
+    "update_model_info(model_dir, max_batch_size=1, cache_size=0)\n",
+    "\n",
+    "cpus = available_cpus()\n",
+    "counts = [count for count in [1, 2, 4, 8, 16, 32] if count <= cpus]\n",
+    "topology_results = []\n",
+    "for num_workers in counts:\n",
+    "    for num_threads in counts:\n",
+    "        throughput, p50, p99 = benchmark_topology(model_dir, sample_requests, num_workers, num_threads, 2 * cpus)\n",
+    "        topology_results.append({'workers': num_workers, 'threads': num_threads, 'requests/s': throughput,\n",
+    "                                 'p50 (ms)': p50, 'p99 (ms)': p99})\n",
+    "\n",
+    "pd.DataFrame(topology_results)"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) A local endpoint\n",
+    "\n",
+    "So far we have called the inference functions directly. To test the whole request path, including the HTTP requests, content types and concurrent requests, without deploying an endpoint, we can run a small HTTP server in the notebook which speaks the same protocol as the SageMaker model server:\n",
+    "\n",
+    " - `GET /ping`: Returns `200` once the model has been loaded.\n",
+    " - `POST /invocations`: Sends the body of the request, along with its `Content-Type` and `Accept` headers, through `input_fn`, `predict_fn` and `output_fn`. A request with an unsupported content type gets a `415` response and a request which can't be decoded a `400`, as these are raised as an `InvalidRequestError` by the inference code. Any other failure is a `500`.\n",
+    " - `GET /metrics`: Returns the latency metrics described above as JSON. When the requests are handled by worker processes only the `invocation` stage, which covers the whole request, is recorded.\n",
+    "\n",
+    "By default the `LocalEndpoint` loads the inference code from `serve/predict.py`, just like the endpoint does. If that file is not available, or if `source_dir` is `None`, the inference code defined in this notebook is used instead. If `num_workers` is larger than `0` the requests are handled by a `WorkerPool`, otherwise each request is handled in a thread of the notebook process.\n",
+    "\n",
+    "Using the `LocalPredictor` we can then send requests to the local endpoint in the same way as we did using the `StringPredictor` earlier."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import http.server\n",
+    "import importlib.util\n",
+    "import types\n",
+    "import urllib.request\n",
+    "\n",
+    "def load_inference_code(source_dir='serve', entry_point='predict.py'):\n",
+    "    \"\"\"Return the module in `source_dir` containing the inference code, or the inference code in this notebook.\"\"\"\n",
+    "    if source_dir is None or not os.path.exists(os.path.join(source_dir, entry_point)):\n",
+    "        return types.SimpleNamespace(model_fn=model_fn, input_fn=input_fn, predict_fn=predict_fn, output_fn=output_fn)\n",
+    "\n",
+    "    # Just like on the endpoint, the inference code may import the other files in source_dir\n",
+    "    if source_dir not in sys.path:\n",
+    "        sys.path.insert(0, source_dir)\n",
+    "    spec = importlib.util.spec_from_file_location(os.path.splitext(entry_point)[0], os.path.join(source_dir, entry_point))\n",
+    "    module = importlib.util.module_from_spec(spec)\n",
+    "    # Register the module so that the objects it defines, such as the errors raised by the workers, can be pickled\n",
+    "    sys.modules[spec.name] = module\n",
+    "    spec.loader.exec_module(module)\n",
+    "    return module\n",
+    "\n",
+    "class EndpointRequestHandler(http.server.BaseHTTPRequestHandler):\n",
+    "    \"\"\"Handle the requests sent to a LocalEndpoint.\"\"\"\n",
+    "\n",
+    "    def do_GET(self):\n",
+    "        if self.path == '/ping':\n",
+    "            self._respond(200, b'')\n",
+    "        elif self.path == '/metrics':\n",
+    "            self._respond(200, json.dumps(self.server.endpoint.metrics.snapshot()).encode('utf-8'), 'application/json')\n",
+    "        else:\n",
+    "            self._respond(404, b'')\n",
+    "\n",
+    "    def do_POST(self):\n",
+    "        if self.path != '/invocations':\n",
+    "            self._respond(404, b'')\n",
+    "            return\n",
+    "\n",
+    "        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))\n",
+    "        content_type = self.headers.get('Content-Type', 'application/json')\n",
+    "        accept = self.headers.get('Accept', 'application/json')\n",
+    "        try:\n",
+    "            with self.server.endpoint.metrics.time('invocation'):\n",
+    "                result = self.server.endpoint.invoke(body, content_type, accept)\n",
+    "        except Exception as e:\n",
+    "            # Errors in the request itself, see InvalidRequestError, are reported as such. The exception may\n",
+    "            # come from a separately loaded module, or a worker process, so we look at its status_code.\n",
+    "            self._respond(getattr(e, 'status_code', 500), str(e).encode('utf-8'))\n",
+    "            return\n",
+    "\n",
+    "        if isinstance(result, str):\n",
+    "            result = result.encode('utf-8')\n",
+    "        self._respond(200, result, accept if accept != '*/*' else 'text/plain')\n",
+    "\n",
+    "    def _respond(self, status, body, content_type='text/plain'):\n",
+    "        self.send_response(status)\n",
+    "        self.send_header('Content-Type', content_type)\n",
+    "        self.send_header('Content-Length', str(len(body)))\n",
+    "        self.end_headers()\n",
+    "        self.wfile.write(body)\n",
+    "\n",
+    "    def log_message(self, format, *args):\n",
+    "        # Don't print a line for every request\n",
+    "        pass\n",
+    "\n",
+    "class LocalEndpoint(object):\n",
+    "    \"\"\"Serve the inference code over HTTP using the same /ping and /invocations routes as a SageMaker endpoint.\"\"\"\n",
+    "\n",
+    "    def __init__(self, model_dir, port=8080, num_workers=0, num_threads=None, source_dir='serve'):\n",
+    "        self.handlers = load_inference_code(source_dir)\n",
+    "        # serve/predict.py is loaded as a separate module, with its own latency metrics\n",
+    "        self.metrics = getattr(self.handlers, 'metrics', metrics)\n",
+    "        self.pool = None\n",
+    "        if num_workers > 0:\n",
+    "            self.pool = WorkerPool(model_dir, num_workers, num_threads, self.handlers)\n",
+    "        else:\n",
+    "            self.model = self.handlers.model_fn(model_dir)\n",
+    "\n",
+    "        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), EndpointRequestHandler)\n",
+    "        self.server.endpoint = self\n",
+    "        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)\n",
+    "        self.thread.start()\n",
+    "\n",
+    "    @property\n",
+    "    def url(self):\n",
+    "        return 'http://127.0.0.1:{}'.format(self.server.server_port)\n",
+    "\n",
+    "    def invoke(self, body, content_type, accept):\n",
+    "        if self.pool is not None:\n",
+    "            return self.pool.invoke(body, content_type, accept)\n",
+    "        handlers = self.handlers\n",
+    "        return handlers.output_fn(handlers.predict_fn(handlers.input_fn(body, content_type), self.model), accept)\n",
+    "\n",
+    "    def stop(self):\n",
+    "        self.server.shutdown()\n",
+    "        self.server.server_close()\n",
+    "        if self.pool is not None:\n",
+    "            self.pool.close()\n",
+    "\n",
+    "class LocalPredictor(object):\n",
+    "    \"\"\"Send requests to a LocalEndpoint, in the same way as the StringPredictor does to a deployed endpoint.\"\"\"\n",
+    "\n",
+    "    def __init__(self, url, content_type='text/plain', accept=None):\n",
+    "        self.url = url\n",
+    "        self.content_type = content_type\n",
+    "        self.accept = accept\n",
+    "\n",
+    "    def predict(self, data):\n",
+    "        if isinstance(data, str):\n",
+    "            data = data.encode('utf-8')\n",
+    "        headers = {'Content-Type': self.content_type}\n",
+    "        if self.accept is not None:\n",
+    "            headers['Accept'] = self.accept\n",
+    "        request = urllib.request.Request(self.url + '/invocations', data=data, headers=headers)\n",
+    "        with urllib.request.urlopen(request) as response:\n",
+    "            return response.read()"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "local_endpoint = LocalEndpoint(model_dir, num_workers=2)\n",
+    "local_predictor = LocalPredictor(local_endpoint.url)\n",
+    "\n",
+    "with urllib.request.urlopen(local_endpoint.url + '/ping') as response:\n",
+    "    print(\"Ping: {}\".format(response.status))\n",
+    "\n",
+    "print(local_predictor.predict(test_review))\n",
+    "print(LocalPredictor(local_endpoint.url, content_type='application/json').predict(json.dumps(batch_reviews)))\n",
+    "\n",
+    "print(\"{:.1f} requests/s\".format(run_concurrently(local_predictor.predict, sample_requests, 8)))\n",
+    "\n",
+    "with urllib.request.urlopen(local_endpoint.url + '/metrics') as response:\n",
+    "    print(json.loads(response.read().decode('utf-8'))['invocation'])\n",
+    "\n",
+    "local_endpoint.stop()"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Load testing\n",
+    "\n",
+    "The `test_reviews` function in Step 6 only tells us how accurate the deployed model is. Before choosing an instance type, or deciding whether one of the optimizations above is worth it, we also need to know how many requests per second the endpoint can handle and how long the requests take. The `load_test` function below replays reviews from the IMDb test set using `send_fn`, which can be `LocalPredictor(url).predict` for a local endpoint or `predictor.predict` for a deployed endpoint, in one of two modes:\n",
+    "\n",
+    " - Closed loop (`concurrency`): A fixed number of clients each send a request as soon as their previous request has completed. This tells us the maximum throughput.\n",
+    " - Open loop (`rate`): Requests arrive at random times, on average `rate` per second, regardless of how long the previous requests take. This is closer to real traffic and, since the latency is measured from the moment a request *should* have been sent, it shows the queueing delay once the endpoint cannot keep up.\n",
+    "\n",
+    "For each run it reports the throughput, the 50th, 95th and 99th percentile latency and the fraction of requests which failed, as well as the fraction which were rejected because of the request itself (a `4xx` response from a local endpoint)."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "def load_imdb_test_reviews(data_dir='../data/aclImdb', limit=1000):\n",
+    "    \"\"\"Return up to `limit` reviews from the IMDb test set, alternating positive and negative, as utf-8.\"\"\"\n",
+    "    files = [sorted(glob.glob(os.path.join(data_dir, 'test', sentiment, '*.txt'))) for sentiment in ['pos', 'neg']]\n",
+    "    reviews = []\n",
+    "    for pos_file, neg_file in zip(*files):\n",
+    "        for f in [pos_file, neg_file]:\n",
+    "            with open(f) as review:\n",
+    "                reviews.append(review.read().encode('utf-8'))\n",
+    "        if len(reviews) >= limit:\n",
+    "            break\n",
+    "    return reviews[:limit]\n",
+    "\n",
+    "def load_test(send_fn, requests, num_requests=None, concurrency=8, rate=None, max_outstanding=256, seed=0):\n",
+    "    \"\"\"Send `num_requests` of `requests` using `send_fn`, closed loop with `concurrency` clients or open loop\n",
+    "    at `rate` requests per second, and return the throughput, latency percentiles and error rate.\"\"\"\n",
+    "    num_requests = num_requests or len(requests)\n",
+    "    bodies = [requests[i % len(requests)] for i in range(num_requests)]\n",
+    "    latencies = []\n",
+    "    errors = []\n",
+    "\n",
+    "    def send(body, scheduled=None):\n",
+    "        start = time.perf_counter() if scheduled is None else scheduled\n",
+    "        try:\n",
+    "            send_fn(body)\n",
+    "        except Exception as e:\n",
+    "            errors.append(e)\n",
+    "            return\n",
+    "        latencies.append(time.perf_counter() - start)\n",
+    "\n",
+    "    start = time.perf_counter()\n",
+    "    if rate is None:\n",
+    "        # Closed loop, each client sends its next request once the previous one has completed\n",
+    "        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:\n",
+    "            list(executor.map(send, bodies))\n",
+    "    else:\n",
+    "        # Open loop, the requests arrive at random (exponentially distributed) intervals\n",
+    "        arrivals = start + np.cumsum(np.random.RandomState(seed).exponential(1.0 / rate, size=num_requests))\n",
+    "        with concurrent.futures.ThreadPoolExecutor(max_outstanding) as executor:\n",
+    "            for body, scheduled in zip(bodies, arrivals):\n",
+    "                delay = scheduled - time.perf_counter()\n",
+    "                if delay > 0:\n",
+    "                    time.sleep(delay)\n",
+    "                executor.submit(send, body, scheduled)\n",
+    "    elapsed = time.perf_counter() - start\n",
+    "\n",
+    "    # Requests which were rejected by the endpoint because of the request itself, such as an HTTP 4xx response\n",
+    "    client_errors = [e for e in errors if 400 <= getattr(e, 'code', 0) < 500]\n",
+    "    result = {'requests': num_requests, 'requests/s': len(latencies) / elapsed, 'error rate': len(errors) / num_requests,\n",
+    "              'client error rate': len(client_errors) / num_requests}\n",
+    "    for q in [50, 95, 99]:\n",
+    "        result['p{} (ms)'.format(q)] = np.percentile(latencies, q) * 1000 if len(latencies) > 0 else float('nan')\n",
+    "    return result"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "imdb_test_requests = load_imdb_test_reviews()\n",
+    "\n",
+    "local_endpoint = LocalEndpoint(model_dir, num_workers=2, source_dir=None)\n",
+    "local_predictor = LocalPredictor(local_endpoint.url)\n",
+    "\n",
+    "load_test_results = []\n",
+    "for concurrency in [1, 4, 16]:\n",
+    "    result = load_test(local_predictor.predict, imdb_test_requests, concurrency=concurrency)\n",
+    "    load_test_results.append(dict(mode='closed loop, concurrency {}'.format(concurrency), **result))\n",
+    "for rate in [20, 50, 100]:\n",
+    "    result = load_test(local_predictor.predict, imdb_test_requests, num_requests=10 * rate, rate=rate)\n",
+    "    load_test_results.append(dict(mode='open loop, {} requests/s'.format(rate), **result))\n",
+    "\n",
+    "local_endpoint.stop()\n",
+    "\n",
+    "pd.DataFrame(load_test_results).set_index('mode')"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Predicting while the user is typing\n",
+    "\n",
+    "A web app which shows the predicted sentiment while the user is typing sends the whole review again every time it changes. Since the LSTM processes the words in order, the state of the LSTM after the first part of the review does not change when words are added at the end, so there is no need to run those words through the model again.\n",
+    "\n",
+    "If the `session_cache_size` setting is larger than `0`, the endpoint accepts `application/json` requests of the form `{\"session\": \"...\", \"review\": \"...\"}`, where the session identifies the text box the review is being typed in. For each session the `SessionStateCache` stores the word ids of the review, except for the last word which may still be incomplete, together with the state of the LSTM after those words. When the next review of the session starts with the same words, only the words after them are run through the model. Otherwise, for example when the user has edited the start of the review, the review is processed from the beginning. Note that the text of the review is still converted into words in full for every request, which for long reviews now takes most of the time. The least recently used sessions are evicted once there are more than `session_cache_size` of them and sessions expire after `session_ttl` seconds."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "def type_review(review, model, session):\n",
+    "    \"\"\"Send `review` one word at a time, the way a web app would while the user is typing it.\"\"\"\n",
+    "    words = review.split()\n",
+    "    outputs = []\n",
+    "    for end in range(1, len(words) + 1):\n",
+    "        body = json.dumps({'session': session, 'review': ' '.join(words[:end])}).encode('utf-8')\n",
+    "        outputs.append(predict_fn(input_fn(body, 'application/json'), model))\n",
+    "    return outputs\n",
+    "\n",
+    "typed_review = ' '.join(review.decode('utf-8') for review in sample_requests[:5])\n",
+    "\n",
+    "start = time.time()\n",
+    "full_outputs = type_review(typed_review, model_fn(model_dir, session_cache_size=0), 'session-1')\n",
+    "print(\"Without the session cache: {:.2f} s\".format(time.time() - start))\n",
+    "\n",
+    "session_model = model_fn(model_dir, session_cache_size=1000)\n",
+    "start = time.time()\n",
+    "session_outputs = type_review(typed_review, session_model, 'session-1')\n",
+    "print(\"With the session cache: {:.2f} s\".format(time.time() - start))\n",
+    "\n",
+    "print(\"Same results: {}\".format(full_outputs == session_outputs))\n",
+    "print(session_model.sessions.stats())"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) A cheaper model in front of the LSTM\n",
+    "\n",
+    "The sentiment of many reviews is obvious from the words they contain, regardless of their order. For these reviews a linear model over the words which appear in the review (a bag-of-words model) is just as accurate as the LSTM while costing next to nothing to evaluate. Below we train such a model, using the same `word_dict` so that it can share the preprocessing with the LSTM, and save it, together with two thresholds, as `cascade.pth`. If the `cascade` setting is `True`, `predict_fn` uses the bag-of-words model for the reviews whose score is at most the low threshold or at least the high threshold, and only runs the LSTM on the remaining reviews.\n",
+    "\n",
+    "The thresholds are chosen by `pick_cascade_thresholds` so that as many reviews as possible are answered by the bag-of-words model while the accuracy drops by at most `max_accuracy_loss` compared to the LSTM. We choose the thresholds using the first half of the test set and then check the result on the second half."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "from scipy.sparse import csr_matrix\n",
+    "from sklearn.linear_model import LogisticRegression\n",
+    "\n",
+    "def bag_of_words(data_X, data_len, vocab_size):\n",
+    "    \"\"\"Return a sparse matrix indicating which words appear in each of the reviews in `data_X`.\"\"\"\n",
+    "    rows, cols = [], []\n",
+    "    for row, (review, length) in enumerate(zip(data_X, data_len)):\n",
+    "        words = np.unique(review[:length])\n",
+    "        rows.extend([row] * len(words))\n",
+    "        cols.extend(words)\n",
+    "    return csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(data_X), vocab_size))\n",
+    "\n",
+    "def pick_cascade_thresholds(scores, lstm_outputs, labels, max_accuracy_loss=0.005, candidates=101):\n",
+    "    \"\"\"Return the low and high thresholds for which the bag-of-words model answers as many reviews as\n",
+    "    possible while the accuracy is at most `max_accuracy_loss` below that of the LSTM.\"\"\"\n",
+    "    labels = np.array(labels)\n",
+    "    cheap_correct = np.round(scores) == labels\n",
+    "    lstm_correct = np.round(lstm_outputs) == labels\n",
+    "    min_accuracy = lstm_correct.mean() - max_accuracy_loss\n",
+    "\n",
+    "    quantiles = np.unique(np.quantile(scores, np.linspace(0, 1, candidates)))\n",
+    "    # A low threshold below 0 (or a high threshold above 1) means that side is never answered\n",
+    "    lows = [-1.0] + [q for q in quantiles if q < 0.5]\n",
+    "    highs = [2.0] + [q for q in quantiles if q >= 0.5]\n",
+    "\n",
+    "    best = (-1.0, 2.0, 0.0)\n",
+    "    for low in lows:\n",
+    "        for high in highs:\n",
+    "            confident = (scores <= low) | (scores >= high)\n",
+    "            accuracy = np.where(confident, cheap_correct, lstm_correct).mean()\n",
+    "            if accuracy >= min_accuracy and confident.mean() > best[2]:\n",
+    "                best = (low, high, confident.mean())\n",
+    "    return best[0], best[1]\n",
+    "\n",
+    "def save_cascade(model_dir, cascade):\n",
+    "    with open(os.path.join(model_dir, 'cascade.pth'), 'wb') as f:\n",
+    "        torch.save(dict(weights=torch.from_numpy(cascade.weights), bias=cascade.bias, low=float(cascade.low), high=float(cascade.high)), f)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "vocab_size = len(local_model.word_dict) + 2\n",
+    "bow_model = LogisticRegression(C=0.1, max_iter=1000)\n",
+    "bow_model.fit(bag_of_words(train_X, train_X_len, vocab_size), train_y)\n",
+    "\n",
+    "cascade = BagOfWordsCascade(bow_model.coef_[0], bow_model.intercept_[0], -1.0, 2.0)\n",
+    "\n",
+    "# The scores of the bag-of-words model and the outputs of the LSTM for both halves of the test set\n",
+    "test_rows = test_X.values\n",
+    "test_scores = np.array([cascade.score(row[1:], row[0]) for row in test_rows])\n",
+    "test_outputs = model_outputs(model_fn(model_dir, cascade=False), test_rows)\n",
+    "half = len(test_rows) // 2\n",
+    "\n",
+    "cascade.low, cascade.high = pick_cascade_thresholds(test_scores[:half], test_outputs[:half], test_y[:half])\n",
+    "save_cascade(model_dir, cascade)\n",
+    "\n",
+    "confident = (test_scores[half:] <= cascade.low) | (test_scores[half:] >= cascade.high)\n",
+    "cascade_predictions = np.round(np.where(confident, test_scores[half:], test_outputs[half:]))\n",
+    "print(\"Thresholds: {:.3f}, {:.3f}\".format(cascade.low, cascade.high))\n",
+    "print(\"LSTM accuracy: {:.4f}, cascade accuracy: {:.4f}, answered by the bag-of-words model: {:.1%}\".format(\n",
+    "    (np.round(test_outputs[half:]) == np.array(test_y[half:])).mean(),\n",
+    "    (cascade_predictions == np.array(test_y[half:])).mean(), confident.mean()))\n",
+    "\n",
+    "for enabled in [False, True]:\n",
+    "    cascade_model = model_fn(model_dir, cascade=enabled)\n",
+    "    metrics.reset()\n",
+    "    for body in sample_requests:\n",
+    "        predict_fn(input_fn(body, 'text/plain'), cascade_model)\n",
+    "    snapshot = metrics.snapshot()\n",
+    "    print(\"Cascade: {}, model time per review: {:.3f} ms\".format(enabled, sum(\n",
+    "        snapshot[stage]['mean_ms'] * snapshot[stage]['count'] for stage in ['cascade', 'forward'] if stage in snapshot) / len(sample_requests)))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) A smaller model trained by the deployed model\n",
+    "\n",
+    "Most of the time spent running the model goes into the LSTM, whose cost grows with the square of `hidden_dim`. A smaller `LSTMClassifier` trained on the labels alone is usually noticeably less accurate, but it does better when it is instead trained to reproduce the outputs of the model we already have. This is known as distillation: the deployed model (the teacher) assigns each training review a probability of being positive, and the smaller model (the student) is trained on these probabilities, mixed with a little of the actual labels (`alpha`), rather than on the labels alone. The students may also use a smaller vocabulary, in which case the less frequent words are treated as infrequent words.\n",
+    "\n",
+    "Below we train several students and compare their accuracy on the test set, their size and their latency for a single review with those of the teacher. A configuration is on the Pareto front if no other configuration is at least as good in all three respects. Using `save_student` the chosen student can be saved as a complete set of model artifacts, which can be tested using the sections above (by setting `model_dir`) and deployed in the same way as the original model."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "def distill(teacher_outputs, train_rows, train_labels, embedding_dim, hidden_dim, vocab_size,\n",
+    "            epochs=5, alpha=0.9, batch_size=50):\n",
+    "    \"\"\"Train an LSTMClassifier on the outputs of the teacher for `train_rows`, mixed with the labels.\"\"\"\n",
+    "    targets = alpha * teacher_outputs + (1 - alpha) * np.array(train_labels, dtype=np.float32)\n",
+    "    rows = limit_vocab(train_rows.copy(), vocab_size)\n",
+    "    \n",
+    "    dataset = torch.utils.data.TensorDataset(torch.from_numpy(rows).long(), torch.from_numpy(targets).float())\n",
+    "    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)\n",
+    "    \n",
+    "    student = LSTMClassifier(embedding_dim, hidden_dim, vocab_size).to(device)\n",
+    "    train(student, loader, epochs, optim.Adam(student.parameters()), torch.nn.BCELoss(), device)\n",
+    "    return student.cpu().eval()\n",
+    "\n",
+    "def pareto_front(results, minimize, maximize):\n",
+    "    \"\"\"Return, for each row of `results`, whether no other row is at least as good in every column.\"\"\"\n",
+    "    values = np.hstack((results[minimize].values, -results[maximize].values))\n",
+    "    return [not any((other <= value).all() and (other < value).any() for other in values) for value in values]\n",
+    "\n",
+    "def save_student(student_dir, student, word_dict, vocab_size, source_dir=model_dir):\n",
+    "    \"\"\"Save the student, with its own model_info and (truncated) word_dict, as a new set of model artifacts.\"\"\"\n",
+    "    model_info, _, _ = load_model_artifacts(source_dir)\n",
+    "    # The ONNX export and the cascade belong to the source model, they are not copied to student_dir\n",
+    "    model_info.update(embedding_dim=student.embedding.embedding_dim, hidden_dim=student.lstm.hidden_size,\n",
+    "                      vocab_size=vocab_size, onnx=False, cascade=False)\n",
+    "    save_model_artifacts(student_dir, model_info, student.state_dict(),\n",
+    "                         {word: idx for word, idx in word_dict.items() if idx < vocab_size})"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "update_model_info(model_dir, quantize=False, compile=False, onnx=False, max_batch_size=1)\n",
+    "teacher = model_fn(model_dir).cpu()\n",
+    "\n",
+    "train_rows = np.hstack((train_X_len.reshape(-1, 1), train_X)).astype(np.int64)\n",
+    "teacher_outputs = model_outputs(teacher, train_rows)\n",
+    "\n",
+    "def describe(name, model, vocab_size):\n",
+    "    rows = limit_vocab(test_X.values.copy(), vocab_size)\n",
+    "    return {'model': name, 'accuracy': evaluate_accuracy(model, rows, test_y),\n",
+    "            'size (KB)': model_size(model) / 1024, 'latency (ms)': time_forward(model, torch.from_numpy(rows[:1])) * 1000}\n",
+    "\n",
+    "teacher_vocab_size = teacher.embedding.num_embeddings\n",
+    "distill_results = [describe('teacher ({}, {}, {})'.format(\n",
+    "    teacher.embedding.embedding_dim, teacher.lstm.hidden_size, teacher_vocab_size), teacher, teacher_vocab_size)]\n",
+    "students = {}\n",
+    "for embedding_dim, hidden_dim, vocab_size in [(32, 100, 5000), (32, 50, 5000), (16, 50, 5000), (32, 50, 2000), (16, 25, 2000)]:\n",
+    "    name = 'student ({}, {}, {})'.format(embedding_dim, hidden_dim, vocab_size)\n",
+    "    students[name] = distill(teacher_outputs, train_rows, train_y, embedding_dim, hidden_dim, vocab_size)\n",
+    "    distill_results.append(describe(name, students[name], vocab_size))\n",
+    "\n",
+    "distill_results = pd.DataFrame(distill_results).set_index('model')\n",
+    "distill_results['pareto'] = pareto_front(distill_results, ['size (KB)', 'latency (ms)'], ['accuracy'])\n",
+    "distill_results"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "# Save one of the students, for example\n",
+    "student_dir = '../model_student'\n",
+    "save_student(student_dir, students['student (32, 50, 5000)'], local_model.word_dict, 5000)\n",
+    "output_fn(predict_fn(input_fn(test_review.encode('utf-8'), 'text/plain'), model_fn(student_dir)), 'text/plain')"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Looking up the input part of the LSTM gates\n",
+    "\n",
+    "At every step the LSTM computes its four gates from the embedding of the current word and from its previous hidden state. The part which depends on the word, `W_ih · E + b`, can only take one of `vocab_size` different values, so instead of computing it for every word of every review we can compute it once, for every word in the vocabulary, when the model is loaded. The `GateTableLSTMClassifier` below does exactly this and then runs the recurrent part of the LSTM, which still depends on the previous hidden state, using a scripted loop.\n",
+    "\n",
+    "Note that PyTorch's own LSTM already computes the input part of the gates for all of the steps at once, using a single (and efficient) matrix multiplication, and that with an `embedding_dim` of `32` this is only a small part of the work compared to the recurrent part. Since the scripted loop has more overhead per step than PyTorch's LSTM, the table may well turn out to be slower, so we check both the results and the timings below. The larger the embedding is compared to the hidden state, the more the table saves.\n",
+    "\n",
+    "With the model trained above the table is roughly twice as slow as PyTorch's LSTM, both for short and for long reviews, so `GateTableLSTMClassifier` is only an experiment and not one of the serving settings read by `model_fn`."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "@torch.jit.script\n",
+    "def lstm_recurrence(gates_x, weight_hh_t, h, c):\n",
+    "    \"\"\"Run the recurrent part of an LSTM, given the input part of the gates for every step.\"\"\"\n",
+    "    outputs = []\n",
+    "    for step in range(gates_x.size(0)):\n",
+    "        gates = gates_x[step] + torch.mm(h, weight_hh_t)\n",
+    "        i, f, g, o = gates.chunk(4, 1)\n",
+    "        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)\n",
+    "        h = torch.sigmoid(o) * torch.tanh(c)\n",
+    "        outputs.append(h)\n",
+    "    return torch.stack(outputs)\n",
+    "\n",
+    "class GateTableLSTMClassifier(nn.Module):\n",
+    "    \"\"\"Computes the same output as the wrapped LSTMClassifier, but looks up the input part of the LSTM\n",
+    "    gates, W_ih · E + b, in a table computed once for every word in the vocabulary.\"\"\"\n",
+    "\n",
+    "    def __init__(self, model):\n",
+    "        super(GateTableLSTMClassifier, self).__init__()\n",
+    "        self.model = model\n",
+    "        lstm = model.lstm\n",
+    "        with torch.no_grad():\n",
+    "            self.register_buffer('gate_table', model.embedding.weight.matmul(lstm.weight_ih_l0.t())\n",
+    "                                 + lstm.bias_ih_l0 + lstm.bias_hh_l0)\n",
+    "            self.register_buffer('weight_hh_t', lstm.weight_hh_l0.t().contiguous())\n",
+    "\n",
+    "    def forward(self, x):\n",
+    "        x = x.t()\n",
+    "        lengths = x[0,:]\n",
+    "        reviews = x[1:,:]\n",
+    "        gates_x = self.gate_table[reviews]\n",
+    "        h = gates_x.new_zeros(reviews.size(1), self.weight_hh_t.size(0))\n",
+    "        lstm_out = lstm_recurrence(gates_x, self.weight_hh_t, h, h)\n",
+    "        # As in TraceableLSTMClassifier, the remainder mimics the negative indexing for reviews of length 0\n",
+    "        last = torch.remainder(lengths - 1, reviews.size(0))\n",
+    "        out = lstm_out.gather(0, last.view(1, -1, 1).expand(1, -1, lstm_out.size(2)))[0]\n",
+    "        return self.model.sig(self.model.dense(out).squeeze())\n",
+    "\n",
+    "eager_model = model_fn(model_dir, quantize=False, compile=False, onnx=False)\n",
+    "gate_table_model = GateTableLSTMClassifier(eager_model).eval()\n",
+    "\n",
+    "with torch.no_grad():\n",
+    "    for length in [10, 100, 500]:\n",
+    "        data = torch.from_numpy(pack_reviews([(row[1:], min(row[0], length)) for row in test_X.values[:1]]))\n",
+    "        difference = (eager_model(data) - gate_table_model(data)).abs().max().item()\n",
+    "        print(\"Review length: {:>3}, largest difference: {:.2e}, LSTM: {:.2f} ms, gate table: {:.2f} ms\".format(\n",
+    "            length, difference, time_forward(eager_model, data) * 1000, time_forward(gate_table_model, data) * 1000))\n",
+    "    \n",
+    "    data = torch.from_numpy(test_X.values[:50])\n",
+    "    print(\"Batch of 50 reviews, LSTM: {:.2f} ms, gate table: {:.2f} ms\".format(\n",
+    "        time_forward(eager_model, data) * 1000, time_forward(gate_table_model, data) * 1000))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Scoring reviews in the Lambda function itself\n",
+    "\n",
+    "For a web app which only receives a handful of reviews a day, keeping an endpoint running all of the time is rather wasteful. The model is small enough that the Lambda function could run it itself, except that PyTorch is far too large to fit in a Lambda deployment package. However, the forward pass of `LSTMClassifier` for a single review is simple enough to write using only NumPy.\n",
+    "\n",
+    "Below, `export_numpy_model` saves the parameters of the model, the `word_dict` and the list of stopwords used by `review_to_words` in a single compressed `.npz` file. The `lambda/lambda_function.py` file contains a `NumpyLSTMClassifier`, which loads this file and performs both the preprocessing and the forward pass, and a `lambda_handler` which can be used in place of the one in Step 7. Since the LSTM is run one word at a time, the input part of the LSTM gates is looked up in a table computed when the model is loaded (see the gate table section above) rather than computed for every word.\n",
+    "\n",
+    "To deploy this, the `lambda` folder needs to be packaged together with `numpy`, `nltk` and `beautifulsoup4` (or `numpy` can be added using a Lambda layer). Note that only the Porter stemmer is used from `nltk`, the stopwords are part of the exported model so that no `nltk` data needs to be downloaded."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "lambda_dir = 'lambda'\n",
+    "if not os.path.exists(lambda_dir):\n",
+    "    os.makedirs(lambda_dir)\n",
+    "\n",
+    "def export_numpy_model(model_dir, path, dtype=np.float32):\n",
+    "    \"\"\"Save the parameters of the model, the word_dict and the stopwords for use by NumpyLSTMClassifier.\"\"\"\n",
+    "    model_info, state_dict, word_dict = load_model_artifacts(model_dir)\n",
+    "    parameters = {name: value.cpu().numpy() for name, value in dequantize_embedding(state_dict).items()}\n",
+    "    np.savez_compressed(path,\n",
+    "                        embedding=parameters['embedding.weight'].astype(dtype),\n",
+    "                        weight_ih=parameters['lstm.weight_ih_l0'].astype(dtype),\n",
+    "                        weight_hh=parameters['lstm.weight_hh_l0'].astype(dtype),\n",
+    "                        bias=(parameters['lstm.bias_ih_l0'] + parameters['lstm.bias_hh_l0']).astype(dtype),\n",
+    "                        dense_weight=parameters['dense.weight'][0].astype(dtype),\n",
+    "                        dense_bias=parameters['dense.bias'].astype(dtype),\n",
+    "                        words=np.array(list(word_dict.keys())),\n",
+    "                        word_ids=np.array(list(word_dict.values()), dtype=np.int32),\n",
+    "                        stopwords=np.array(stopwords.words(\"english\")))\n",
+    "\n",
+    "export_numpy_model(model_dir, os.path.join(lambda_dir, 'model.npz'))"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "%%writefile lambda/lambda_function.py\n",
+    "import os\n",
+    "import re\n",
+    "\n",
+    "import numpy as np\n",
+    "from bs4 import BeautifulSoup\n",
+    "from nltk.stem.porter import PorterStemmer\n",
+    "\n",
+    "def sigmoid(x):\n",
+    "    return 0.5 * (1.0 + np.tanh(0.5 * x))\n",
+    "\n",
+    "class NumpyLSTMClassifier(object):\n",
+    "    \"\"\"The preprocessing and the forward pass of LSTMClassifier for a single review, using only NumPy.\"\"\"\n",
+    "\n",
+    "    def __init__(self, path):\n",
+    "        with np.load(path) as data:\n",
+    "            embedding = data['embedding'].astype(np.float32)\n",
+    "            weight_ih = data['weight_ih'].astype(np.float32)\n",
+    "            bias = data['bias'].astype(np.float32)\n",
+    "            self.weight_hh = data['weight_hh'].astype(np.float32)\n",
+    "            self.dense_weight = data['dense_weight'].astype(np.float32)\n",
+    "            self.dense_bias = float(data['dense_bias'][0])\n",
+    "            self.word_dict = dict(zip(data['words'].tolist(), data['word_ids'].tolist()))\n",
+    "            self.stopwords = set(data['stopwords'].tolist())\n",
+    "\n",
+    "        # The input part of the LSTM gates only depends on the word, so we compute it once for every word\n",
+    "        self.gate_table = embedding.dot(weight_ih.T) + bias\n",
+    "        self.hidden_dim = self.weight_hh.shape[1]\n",
+    "        self.stemmer = PorterStemmer()\n",
+    "\n",
+    "    def review_to_words(self, review):\n",
+    "        text = BeautifulSoup(review, \"html.parser\").get_text() # Remove HTML tags\n",
+    "        text = re.sub(r\"[^a-zA-Z0-9]\", \" \", text.lower()) # Convert to lower case\n",
+    "        return [self.stemmer.stem(w) for w in text.split() if w not in self.stopwords]\n",
+    "\n",
+    "    def predict_proba(self, review, pad=500):\n",
+    "        \"\"\"Return the probability that `review` is positive, as computed by LSTMClassifier.\"\"\"\n",
+    "        words = self.review_to_words(review)[:pad]\n",
+    "        # Words which are not in the word_dict are infrequent (1). An empty review is all padding (0), of which\n",
+    "        # LSTMClassifier uses the output at the last position.\n",
+    "        word_ids = [self.word_dict.get(word, 1) for word in words] or [0] * pad\n",
+    "\n",
+    "        h = np.zeros(self.hidden_dim, dtype=np.float32)\n",
+    "        c = np.zeros(self.hidden_dim, dtype=np.float32)\n",
+    "        for word_id in word_ids:\n",
+    "            gates = self.gate_table[word_id] + self.weight_hh.dot(h)\n",
+    "            i, f, g, o = np.split(gates, 4)\n",
+    "            c = sigmoid(f) * c + sigmoid(i) * np.tanh(g)\n",
+    "            h = sigmoid(o) * np.tanh(c)\n",
+    "        return float(sigmoid(self.dense_weight.dot(h) + self.dense_bias))\n",
+    "\n",
+    "# The model is loaded once per Lambda container, on the first request\n",
+    "model = None\n",
+    "\n",
+    "def lambda_handler(event, context):\n",
+    "    global model\n",
+    "    if model is None:\n",
+    "        model = NumpyLSTMClassifier(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model.npz'))\n",
+    "\n",
+    "    result = str(np.round(model.predict_proba(event['body'])))\n",
+    "\n",
+    "    return {\n",
+    "        'statusCode' : 200,\n",
+    "        'headers' : { 'Content-Type' : 'text/plain', 'Access-Control-Allow-Origin' : '*' },\n",
+    "        'body' : result\n",
+    "    }"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(lambda_dir, 'lambda_function.py'))\n",
+    "lambda_function = importlib.util.module_from_spec(spec)\n",
+    "spec.loader.exec_module(lambda_function)\n",
+    "\n",
+    "update_model_info(model_dir, quantize=False, compile=False, onnx=False)\n",
+    "torch_model = model_fn(model_dir).cpu()\n",
+    "numpy_model = lambda_function.NumpyLSTMClassifier(os.path.join(lambda_dir, 'model.npz'))\n",
+    "\n",
+    "differences = []\n",
+    "torch_time, numpy_time = 0, 0\n",
+    "for body in sample_requests[:200] + [b'']:\n",
+    "    review = body.decode('utf-8')\n",
+    "\n",
+    "    start = time.time()\n",
+    "    with torch.no_grad():\n",
+    "        data = torch.from_numpy(pack_reviews([convert_and_pad(torch_model.word_dict, review_to_words(review))]))\n",
+    "        torch_output = torch_model(data).item()\n",
+    "    torch_time += time.time() - start\n",
+    "\n",
+    "    start = time.time()\n",
+    "    numpy_output = numpy_model.predict_proba(review)\n",
+    "    numpy_time += time.time() - start\n",
+    "\n",
+    "    differences.append(abs(torch_output - numpy_output))\n",
+    "\n",
+    "print(\"Largest difference: {:.2e}\".format(max(differences)))\n",
+    "print(\"PyTorch: {:.2f} ms, NumPy: {:.2f} ms per review\".format(torch_time * 1000 / 201, numpy_time * 1000 / 201))\n",
+    "print(\"Size of model.npz: {:.0f} KB\".format(os.path.getsize(os.path.join(lambda_dir, 'model.npz')) / 1024))\n",
+    "print(lambda_function.lambda_handler({'body': test_review}, None))"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Smaller model artifacts\n",
+    "\n",
+    "Every new instance (and, with a cold start, every scaled out instance) has to download and load the model artifacts before it can answer requests. Of these, the embedding table in `model.pth` has a row of `embedding_dim` floats for each of the `vocab_size` words and `word_dict.pkl` contains every word in the vocabulary. We can make both smaller:\n",
+    "\n",
+    " - Each row of the embedding table is stored using 8 bit integers together with a single float scale for the row, so that the largest value in the row maps to `127`. `model_fn` turns these back into float32 values when the model is loaded.\n",
+    " - Words whose embedding is within `max_distance` of the embedding of the infrequent words (`INFREQ`) are removed from the vocabulary. These words are then treated as infrequent, and the remaining words are renumbered so that the embedding table has fewer rows. Since this changes the word ids, `compress_artifacts` also returns the mapping from the old to the new word ids, which we use to convert the test set.\n",
+    "\n",
+    "Since the effect of both changes on the accuracy of the model is hard to predict, `compress_artifacts` checks the accuracy of the compressed model on the given data and raises an exception if it drops by more than `max_accuracy_drop`. The compressed artifacts are written to a separate folder. Note that they can't simply be deployed in place of the original artifacts: the word ids are different, so requests containing processed reviews have to be converted using the returned mapping first, and the ONNX export and the cascade are turned off since they use the old word ids. Only clients which send the text of the reviews are unaffected."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "def artifacts_size(model_dir):\n",
+    "    \"\"\"Return the number of bytes taken by the model_info.pth, model.pth and word_dict.pkl files in `model_dir`.\"\"\"\n",
+    "    return sum(os.path.getsize(os.path.join(model_dir, name)) for name in ['model_info.pth', 'model.pth', 'word_dict.pkl'])\n",
+    "\n",
+    "def compress_artifacts(model_dir, out_dir, data_X, data_y, max_distance=0.0, max_accuracy_drop=0.005):\n",
+    "    \"\"\"Write the artifacts in `model_dir` to `out_dir` using a per-row int8 embedding table and leaving out the\n",
+    "    words whose embedding is within `max_distance` of the embedding of infrequent words. Returns the mapping\n",
+    "    from the old to the new word ids.\"\"\"\n",
+    "    model_info, state_dict, word_dict = load_model_artifacts(model_dir)\n",
+    "\n",
+    "    state_dict = dequantize_embedding(state_dict)\n",
+    "    embedding = state_dict['embedding.weight'].cpu()\n",
+    "    distance = (embedding - embedding[1]).norm(dim=1).numpy()\n",
+    "    # We always keep the 'no word' (0) and 'infrequent' (1) rows, the pruned words become infrequent\n",
+    "    keep = [0, 1] + [idx for idx in range(2, len(embedding)) if distance[idx] > max_distance]\n",
+    "    new_ids = np.ones(len(embedding), dtype=np.int64)\n",
+    "    new_ids[keep] = np.arange(len(keep))\n",
+    "\n",
+    "    embedding = embedding[keep]\n",
+    "    scale = embedding.abs().max(dim=1)[0].clamp(min=1e-12) / 127\n",
+    "    state_dict = dict(state_dict)\n",
+    "    del state_dict['embedding.weight']\n",
+    "    state_dict['embedding.weight_int8'] = torch.round(embedding / scale.view(-1, 1)).to(torch.int8)\n",
+    "    state_dict['embedding.weight_scale'] = scale\n",
+    "\n",
+    "    word_dict = {word: int(new_ids[idx]) for word, idx in word_dict.items() if new_ids[idx] > 1}\n",
+    "    # The ONNX export and the cascade use the old word ids, so they can't be used with the new artifacts\n",
+    "    model_info.update(vocab_size=len(keep), onnx=False, cascade=False)\n",
+    "\n",
+    "    save_model_artifacts(out_dir, model_info, state_dict, word_dict)\n",
+    "\n",
+    "    # Check that the compressed model is still about as accurate as the original one, using the plain PyTorch\n",
+    "    # model in both cases\n",
+    "    plain = dict(quantize=False, compile=False, onnx=False, cascade=False, max_batch_size=1, cache_size=0,\n",
+    "                 session_cache_size=0, warmup=False)\n",
+    "    original_accuracy = evaluate_accuracy(model_fn(model_dir, **plain).cpu(), data_X, data_y)\n",
+    "    compressed_X = data_X.copy()\n",
+    "    compressed_X[:, 1:] = new_ids[compressed_X[:, 1:]]\n",
+    "    compressed_accuracy = evaluate_accuracy(model_fn(out_dir, **plain).cpu(), compressed_X, data_y)\n",
+    "\n",
+    "    print(\"Vocabulary: {} -> {} words, artifacts: {:.0f} KB -> {:.0f} KB, accuracy: {:.4f} -> {:.4f}\".format(\n",
+    "        len(distance), len(keep), artifacts_size(model_dir) / 1024, artifacts_size(out_dir) / 1024,\n",
+    "        original_accuracy, compressed_accuracy))\n",
+    "    if original_accuracy - compressed_accuracy > max_accuracy_drop:\n",
+    "        raise Exception('The accuracy of the compressed model dropped by {:.4f}.'.format(\n",
+    "            original_accuracy - compressed_accuracy))\n",
+    "    return new_ids"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "# The embedding table of the plain PyTorch model\n",
+    "embedding = model_fn(model_dir, quantize=False, compile=False, onnx=False).embedding.weight.detach().cpu()\n",
+    "distances = (embedding[2:] - embedding[1]).norm(dim=1).numpy()\n",
+    "\n",
+    "# Prune more and more of the vocabulary, until the accuracy drops too much\n",
+    "compressed_dir = '../model_compressed'\n",
+    "for fraction in [0.0, 0.1, 0.25, 0.5]:\n",
+    "    max_distance = np.quantile(distances, fraction) if fraction > 0 else 0.0\n",
+    "    try:\n",
+    "        compress_artifacts(model_dir, compressed_dir, test_X.values, test_y, max_distance)\n",
+    "        chosen_distance = max_distance\n",
+    "    except Exception as e:\n",
+    "        print(e)\n",
+    "        break\n",
+    "\n",
+    "# Write the artifacts using the largest amount of pruning which passed the accuracy check\n",
+    "word_id_map = compress_artifacts(model_dir, compressed_dir, test_X.values, test_y, chosen_distance)"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) A compact format for reviews which have already been processed\n",
+    "\n",
+    "When scoring the test set in Step 7 we sent the processed reviews, each of which is a row of `501` integers, as text. Most of these integers are the `0`s used for padding, and written out as text each word id takes several bytes. Besides reviews as text, `input_fn` above also accepts processed reviews (`len, review[...]` rows) in the following formats, all of which can be created on the client side using `serialize_reviews`:\n",
+    "\n",
+    " - `text/csv`: One comma separated row per line. This is what we have been sending so far.\n",
+    " - `application/x-npy`: The rows as a NumPy array of 16 bit integers, in the `.npy` format.\n",
+    " - `application/x-review-ids`: The number of reviews (a 32 bit integer), then the length of each review and then the word ids of all of the reviews, all as 16 bit integers. This leaves out the padding entirely.\n",
+    "\n",
+    "Adding `; compression=zlib` to the content type (which `serialize_reviews` does if `compress` is `True`) means that the body of the request is compressed using `zlib`. Since the endpoint rejects requests larger than 6 MB, a smaller request means more reviews per request and so fewer requests. Below we compare the size of the requests and the time taken by sending them to the local endpoint."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "update_model_info(model_dir, quantize=False, compile=False, onnx=False, cascade=False, cache_size=0)\n",
+    "local_endpoint = LocalEndpoint(model_dir, source_dir=None)\n",
+    "\n",
+    "chunks = np.array_split(test_X.values[:2000], 4)\n",
+    "expected = None\n",
+    "serialization_results = []\n",
+    "for content_type, compress in [('text/csv', False), ('text/csv', True), ('application/x-npy', False),\n",
+    "                               ('application/x-npy', True), ('application/x-review-ids', False),\n",
+    "                               ('application/x-review-ids', True)]:\n",
+    "    size, outputs = 0, []\n",
+    "    start = time.time()\n",
+    "    for chunk in chunks:\n",
+    "        body, request_content_type = serialize_reviews(chunk, content_type, compress)\n",
+    "        size += len(body)\n",
+    "        outputs.extend(json.loads(LocalPredictor(local_endpoint.url, request_content_type).predict(body).decode('utf-8')))\n",
+    "    elapsed = time.time() - start\n",
+    "    \n",
+    "    # All of the formats should of course give the same results\n",
+    "    expected = outputs if expected is None else expected\n",
+    "    assert outputs == expected\n",
+    "    serialization_results.append({'format': request_content_type, 'bytes per review': size / 2000,\n",
+    "                                  'time (s)': elapsed})\n",
+    "\n",
+    "local_endpoint.stop()\n",
+    "\n",
+    "pd.DataFrame(serialization_results).set_index('format')"
+   ]
+  },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "### (Optional) Scoring a large number of reviews without an endpoint\n",
+    "\n",
+    "To score a large collection of reviews, say every night, we don't need an endpoint at all. The `batch_transform` function below uses the same model artifacts that `model_fn` loads to score the reviews in `source`, which is either a folder containing one review per `.txt` file (such as `../data/aclImdb/test`) or a file containing one JSON encoded review per line (either a string or an object with `id` and `review` fields). It works through the reviews in shards of `shard_size` reviews:\n",
+    "\n",
+    " 1. The reviews of the shard are converted into word ids by a pool of `num_processes` processes.\n",
+    " 2. The reviews are sorted by length and run through the model in batches of `batch_size` reviews, so that the reviews in a batch need little padding, using `num_threads` threads.\n",
+    " 3. The results are appended to `output_path`, one JSON object per line in the same order as the reviews in `source`, after which the number of reviews done so far is written to a progress file (`output_path` followed by `.progress`).\n",
+    "\n",
+    "If the job is interrupted it can simply be started again: the reviews done so far, according to the progress file, are skipped and anything written to `output_path` after that is discarded."
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "import itertools\n",
+    "\n",
+    "# The word_dict used by the normalization processes of batch_transform, set before they are forked\n",
+    "_transform_word_dict = None\n",
+    "\n",
+    "def _normalize_review(review):\n",
+    "    data_X, data_len = convert_and_pad(_transform_word_dict, review_to_words(review))\n",
+    "    return np.array(data_X, dtype=np.int64), data_len\n",
+    "\n",
+    "def iter_reviews(source):\n",
+    "    \"\"\"Yield the id and the text of each review in `source`, a folder of .txt files or a JSON lines file.\"\"\"\n",
+    "    if os.path.isdir(source):\n",
+    "        for path in sorted(glob.glob(os.path.join(source, '**', '*.txt'), recursive=True)):\n",
+    "            with open(path) as f:\n",
+    "                yield os.path.relpath(path, source), f.read()\n",
+    "    else:\n",
+    "        with open(source) as f:\n",
+    "            for line_number, line in enumerate(f):\n",
+    "                if line.strip():\n",
+    "                    review = json.loads(line)\n",
+    "                    if isinstance(review, str):\n",
+    "                        yield line_number, review\n",
+    "                    else:\n",
+    "                        yield review['id'], review['review']\n",
+    "\n",
+    "def batch_transform(model_dir, source, output_path, shard_size=5000, batch_size=256,\n",
+    "                    num_processes=None, num_threads=None, resume=True):\n",
+    "    \"\"\"Score the reviews in `source` using the model in `model_dir` and write the results to `output_path`.\"\"\"\n",
+    "    global _transform_word_dict\n",
+    "    progress_path = output_path + '.progress'\n",
+    "    done, offset = 0, 0\n",
+    "    if resume and os.path.exists(progress_path) and os.path.exists(output_path):\n",
+    "        with open(progress_path) as f:\n",
+    "            progress = json.load(f)\n",
+    "        done, offset = progress['reviews'], progress['offset']\n",
+    "        print(\"Resuming after {} reviews.\".format(done))\n",
+    "\n",
+    "    model = model_fn(model_dir).eval()\n",
+    "    device = torch.device(\"cuda\" if torch.cuda.is_available() else \"cpu\")\n",
+    "    if num_threads is not None:\n",
+    "        torch.set_num_threads(num_threads)\n",
+    "\n",
+    "    _transform_word_dict = model.word_dict\n",
+    "    pool = multiprocessing.get_context('fork').Pool(num_processes or available_cpus())\n",
+    "\n",
+    "    try:\n",
+    "        reviews = itertools.islice(iter_reviews(source), done, None)\n",
+    "        with open(output_path, 'r+b' if offset > 0 else 'wb') as output:\n",
+    "            # Anything written after the last recorded progress belongs to an unfinished shard\n",
+    "            output.truncate(offset)\n",
+    "            output.seek(offset)\n",
+    "            while True:\n",
+    "                shard = list(itertools.islice(reviews, shard_size))\n",
+    "                if len(shard) == 0:\n",
+    "                    break\n",
+    "\n",
+    "                rows = pool.map(_normalize_review, [text for _, text in shard], chunksize=64)\n",
+    "\n",
+    "                # Longest reviews first, so that each batch only needs to be padded to its first review\n",
+    "                order = sorted(range(len(rows)), key=lambda i: rows[i][1], reverse=True)\n",
+    "                scores = np.empty(len(rows))\n",
+    "                with torch.no_grad():\n",
+    "                    for begin in range(0, len(order), batch_size):\n",
+    "                        batch = order[begin:begin + batch_size]\n",
+    "                        data = torch.from_numpy(pack_reviews([rows[i] for i in batch])).to(device)\n",
+    "                        scores[batch] = model(data).cpu().numpy().reshape(-1)\n",
+    "\n",
+    "                for (review_id, _), score in zip(shard, scores):\n",
+    "                    record = {'id': review_id, 'score': float(score), 'sentiment': int(round(score))}\n",
+    "                    output.write((json.dumps(record) + '\\n').encode('utf-8'))\n",
+    "                output.flush()\n",
+    "                os.fsync(output.fileno())\n",
+    "\n",
+    "                done += len(shard)\n",
+    "                with open(progress_path + '.tmp', 'w') as f:\n",
+    "                    json.dump({'reviews': done, 'offset': output.tell()}, f)\n",
+    "                os.replace(progress_path + '.tmp', progress_path)\n",
+    "                print(\"Scored {} reviews.\".format(done))\n",
+    "    finally:\n",
+    "        pool.close()\n",
+    "        pool.join()\n",
+    "    return done"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {},
+   "outputs": [],
+   "source": [
+    "update_model_info(model_dir, quantize=False, compile=False, onnx=False, cascade=False, max_batch_size=1)\n",
+    "batch_transform(model_dir, '../data/aclImdb/test', '../data/test_scores.jsonl')\n",
+    "\n",
+    "test_scores = pd.read_json('../data/test_scores.jsonl', lines=True)\n",
+    "test_scores['label'] = test_scores['id'].str.startswith('pos').astype(int)\n",
+    "print(\"Accuracy: {:.4f}\".format((test_scores['sentiment'] == test_scores['label']).mean()))\n",
+    "test_scores.head()"
+   ]
+  },
   {
    "cell_type": "code",
    "execution_count": null,